@@ -0,0 +1,56 @@
+#
+#   gunicorn configuration for the production server
+#   Usage: gunicorn -c gunicorn.conf.py src.main:app
+#
+
+# The application is preloaded in the master process, so the standard library
+# has to be patched before anything else gets imported
+from gevent import monkey
+
+monkey.patch_all()
+
+import os
+import multiprocessing
+
+bind = f"0.0.0.0:{os.environ.get('PORT', 8080)}"
+
+# One gevent worker per core; F1 instances only have a single core
+workers = int(os.environ.get("WEB_CONCURRENCY", multiprocessing.cpu_count()))
+worker_class = "gevent"
+# Maximum number of concurrent greenlets (requests) per worker
+worker_connections = int(os.environ.get("WORKER_CONNECTIONS", 1000))
+
+# Telegram reuses its connection to the webhook, so keep it alive for a while
+keepalive = 75
+# Reminders and broadcasts are long-running requests
+timeout = 600
+# Time given to in-flight requests and fan-outs before a worker is killed
+graceful_timeout = 60
+# Time given to fan-outs in worker_exit, which only runs after the worker has
+# already waited for in-flight requests, so the master may kill it at any moment
+DRAIN_TIMEOUT = 15
+
+# create_app() is only run once in the master so that workers fork quickly
+preload_app = True
+
+accesslog = "-"
+errorlog = "-"
+
+
+# Start retrying replies left by previous workers once the worker is ready
+def post_worker_init(worker):
+    from src.model.replyOutbox import ReplyOutbox
+
+    ReplyOutbox.startAll()
+
+
+# Replies still waiting to be retried are saved for other workers to send first,
+# then in-flight broadcasts and reminders are given a short time to finish
+def worker_exit(server, worker):
+    from src.util.trackedGroup import TrackedGroup
+    from src.model.replyOutbox import ReplyOutbox
+
+    ReplyOutbox.persistAll()
+
+    if not TrackedGroup.drainAll(DRAIN_TIMEOUT):
+        worker.log.warning("Worker exited with undelivered messages")
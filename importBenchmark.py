@@ -0,0 +1,71 @@
+#
+#   Measures how long it takes to import the application, which dominates the
+#   cold start of a new App Engine instance
+#
+#   Usage: python importBenchmark.py [--runs 5] [--top 15] [--budget SECONDS]
+#
+
+import re
+import sys
+import argparse
+import subprocess
+from statistics import median
+
+# Matches lines of the form "import time: self [us] | cumulative | imported package"
+LINE_PATTERN = re.compile(r"import time:\s+(\d+)\s+\|\s+(\d+)\s+\|(\s+)(\S+)")
+
+
+# Imports the application in a fresh interpreter
+# Returns the total import time and the cumulative import time of each module
+# imported directly by the application in seconds
+def measure(target: str) -> tuple:
+    proc = subprocess.run(
+        [sys.executable, "-X", "importtime", "-c", f"import {target}"],
+        stderr=subprocess.PIPE,
+        universal_newlines=True,
+    )
+
+    if proc.returncode != 0:
+        print(proc.stderr)
+        exit(1)
+
+    total, modules = 0, {}
+    for line in proc.stderr.splitlines():
+        match = LINE_PATTERN.match(line)
+        if not match:
+            continue
+
+        # Nesting is indicated by 2 spaces per level
+        depth = (len(match.group(3)) + 1) // 2
+        cumulative = int(match.group(2)) / 1e6
+
+        if depth == 1:
+            total += cumulative
+        elif depth == 2:
+            modules[match.group(4)] = cumulative
+
+    return total, modules
+
+
+if __name__ == "__main__":
+
+    parser = argparse.ArgumentParser(description="Measure application import time")
+    parser.add_argument("--runs", type=int, default=5)
+    parser.add_argument("--top", type=int, default=15)
+    parser.add_argument("--target", default="src.app", help="Module to import")
+    parser.add_argument(
+        "--budget", type=float, help="Exit with an error if the import takes longer"
+    )
+    args = parser.parse_args()
+
+    runs = [measure(args.target) for _ in range(args.runs)]
+    total = median(x[0] for x in runs)
+    modules = {name: median(x[1].get(name, 0) for x in runs) for name in runs[0][1]}
+
+    print(f"Median import time over {args.runs} runs: {total:.3f}s\n")
+    for name, seconds in sorted(modules.items(), key=lambda x: -x[1])[: args.top]:
+        print(f"{seconds:8.3f}s  {name}")
+
+    if args.budget is not None and total > args.budget:
+        print(f"\nImport time exceeds budget of {args.budget:.3f}s")
+        exit(1)
@@ -1,16 +1,31 @@
+import os
 import logging
 import json
-from typing import List
-from flask import Flask, request, jsonify
-from google.cloud import ndb
+from time import time
+from datetime import datetime, timedelta
+from flask import Flask, Response, request, jsonify
 
 from .util.telegramWrapper import TelegramApiWrapper
+from .util.ndbClient import getNdbClient
+from .util.ndbMiddleware import NdbMiddleware
+from .util.updateDeduplicator import UpdateDeduplicator
+from .util.profiler import profiled
+from .util.updateRecorder import UpdateRecorder
+from .util.workQueue import WorkQueue, QueueFullError
+from .util.fmtDateTime import FmtDateTime
 
 from .stringConstants import StringConstants
+from .model.user import User
 from .model.webhookUpdate import WebhookUpdate
+from .model.telegramMarkup import TelegramMarkup
 from .model.updateHandler import UpdateHandler
 from .model.broadcastHandler import BroadcastHandler
 from .model.reminderHandler import ReminderHandler
+from .model.reminderRun import ReminderRun
+from .model.rosterHandler import RosterHandler
+from .model.replyOutbox import ReplyOutbox
+from .model.submission import Submission
+from .model.userStats import UserStats, StatsNotCountedError
 
 # Configure logging
 logging.basicConfig(
@@ -27,13 +42,34 @@ def loadSecrets():
 def create_app():
 
     app = Flask(__name__)
+    # All requests share the same NDB client and run within their own context
+    app.wsgi_app = NdbMiddleware(app.wsgi_app)
     logger = logging.getLogger(__name__)
 
     SECRETS = loadSecrets()
     STRINGS = StringConstants().STRINGS
     telegramApi = TelegramApiWrapper(SECRETS["telegram-bot"])
-
-    ndbClient = ndb.Client()
+    # Updates beyond what the instance can work on wait here, and once too many are
+    # waiting they are rejected so that Telegram redelivers them later
+    webhookQueue = WorkQueue(
+        "webhook",
+        int(os.environ.get("WEBHOOK_CONCURRENCY", 50)),
+        maxWaiting=int(os.environ.get("WEBHOOK_QUEUE_SIZE", 100)),
+    )
+    # Replies that fail to send are retried in the background
+    outbox = ReplyOutbox(telegramApi)
+    # Redis is only required to deduplicate updates across multiple instances
+    deduplicator = UpdateDeduplicator(SECRETS.get("redis-url"))
+    # Requests carrying this token can be profiled (see util.profiler)
+    adminToken = SECRETS.get("admin-token")
+    # Anonymised updates are appended to this file for replaying (see replay.py)
+    recorder = None
+    if SECRETS.get("record-updates"):
+        recorder = UpdateRecorder(
+            SECRETS["record-updates"],
+            SECRETS.get("record-salt"),
+            TelegramMarkup.keyboardTexts(),
+        )
 
     # Endpoints are placed behind the bot token to limit accessibility
     def getRouteUrl(endpoint):
@@ -56,9 +92,28 @@ def create_app():
     #   Define application routes
     #
 
+    # App Engine sends this before routing traffic to a new instance, so that the
+    # first webhook doesn't have to pay for opening connections
+    @app.route("/_ah/warmup")
+    def warmupRoute():
+
+        start = time()
+
+        # Open the gRPC channel to Datastore
+        getNdbClient()
+        User.get_by_id("_warmup")
+
+        # Open a pooled TLS connection to Telegram
+        telegramApi.getMe()
+
+        logStr = f"Warmed up in {time() - start:.4f}s"
+        logger.info(logStr)
+        return logStr
+
     # Endpoint for Telegram Bot API webhook
     # In order to facilitate testing, the response wi
     @app.route(getRouteUrl("webhook"), methods=["POST"])
+    @profiled(adminToken)
     def webhookRoute():
         try:
             body = request.get_json()
@@ -67,45 +122,167 @@ def create_app():
             logging.warning(logStr)
             return makeResponse(logStr)
 
+        # Redeliveries and rejected updates are part of the load, so they are recorded
+        # too. Replays keep their update IDs apart so they are deduplicated the same way
+        if recorder is not None:
+            recorder.record(body)
+
+        # Rejected updates aren't marked as seen, so their redelivery is processed
+        try:
+            with webhookQueue.slot():
+                return processUpdate(body)
+        except QueueFullError:
+            logger.warning("Rejected update as the webhook queue is full")
+            return "Busy, retry later", 503, {"Retry-After": "1"}
+
+    def processUpdate(body):
+
+        # Telegram redelivers updates that weren't acknowledged quickly enough
+        if deduplicator.isDuplicate(body.get("update_id")):
+            return makeResponse("Received duplicate update")
+
+        # Failed updates are redelivered by Telegram and have to be processed again
+        try:
+            return handleUpdate(body)
+        except Exception:
+            deduplicator.forget(body.get("update_id"))
+            raise
+
+    def handleUpdate(body):
+
         # Extract message component from update
-        if "message" in body:
-            message = body["message"]
-        elif "edited_message" in body:
-            message = body["edited_message"]
-        else:
+        updateObj = WebhookUpdate.fromBody(body)
+        if updateObj is None:
             # No message component
             return makeResponse("Received update with no message component")
 
-        updateObj = WebhookUpdate(updateId=body["update_id"], messageObj=message)
-
         if not updateObj.isValid():
             logStr = "Invalid update object"
             logger.warning(logStr)
             return logStr
 
-        with ndbClient.context():
-            updateHandler = UpdateHandler(updateObj)
-            resp = updateHandler.process()
+        # Drop updates from groups the bot was added to before they reach Datastore
+        if not updateObj.isPrivate():
+            return makeResponse("Ignored update from non-private chat")
+
+        updateHandler = UpdateHandler(updateObj)
+        resp = updateHandler.process()
 
-        telegramApi.sendMessage(resp)
+        # The user's state has already been saved, so the reply mustn't be lost
+        outbox.send(resp)
 
         return makeResponse(resp)
 
     # Endpoint for Cloud scheduler
+    # If reminders are spread over a window, the scheduler calls this every minute of
+    # the window, optionally passing the sub-slot as ?offset=
     @app.route(getRouteUrl("remind"))
+    @profiled(adminToken)
     def remindRoute():
 
-        with ndbClient.context():
-            return ReminderHandler.remind(telegramApi)
+        offset = request.args.get("offset", type=int)
+        return ReminderHandler.remind(telegramApi, offset)
+
+    # Reports delivery timings of recent reminder runs
+    @app.route(getRouteUrl("remind/runs"))
+    def remindRunsRoute():
+
+        limit = request.args.get("limit", 20, type=int)
+        return jsonify([x.toDict() for x in ReminderRun.latest(limit)])
+
+    # Live counts of users in each state, blocked users and submissions this session
+    @app.route(getRouteUrl("stats"))
+    def statsRoute():
+        try:
+            return jsonify(UserStats.read())
+        except StatsNotCountedError:
+            logStr = "Stats haven't been counted yet, run python -m src.migrate --recount"
+            return logStr, 503
+
+    # Streams the submissions of a group as CSV for dates from ?start= to ?end=
+    # (YYYY-MM-DD, both inclusive), defaulting to the last 30 days
+    @app.route(getRouteUrl("export/submissions"))
+    def exportSubmissionsRoute():
+
+        groupId = request.args.get("groupId")
+        if not groupId:
+            return "Missing groupId", 400
+
+        try:
+            end = request.args.get("end")
+            end = datetime.strptime(end, "%Y-%m-%d").date() if end else None
+            start = request.args.get("start")
+            start = datetime.strptime(start, "%Y-%m-%d").date() if start else None
+        except ValueError:
+            return "Dates must be in the format YYYY-MM-DD", 400
+
+        end = end or FmtDateTime.now().dateObj.date()
+        start = start or end - timedelta(days=30)
+
+        # The response is streamed after the request's context has closed, so pages
+        # are fetched in a context of their own (see util.pagedQuery)
+        return Response(
+            Submission.iterCsv(groupId, start, end),
+            mimetype="text/csv",
+            headers={
+                "Content-Disposition": f"attachment; filename={groupId}_{start}_{end}.csv"
+            },
+        )
+
+    # Current load on the instance's work queues (see util.workQueue)
+    @app.route(getRouteUrl("queues"))
+    def queuesRoute():
+        return jsonify(WorkQueue.allGauges())
+
+    # Endpoint for Cloud scheduler to refresh the stored rosters of all groups
+    @app.route(getRouteUrl("roster/refresh"))
+    def rosterRefreshRoute():
+        return RosterHandler.refreshAll()
 
     # Endpoint for sending broadcasts
+    # The broadcast is sent in the background and its progress can be queried by ID
+    # Recipients can be restricted with "filters" (see BroadcastHandler.FILTERS)
+    # Passing ?wait blocks until the broadcast is finished
     @app.route(getRouteUrl("broadcast"), methods=["POST"])
+    @profiled(adminToken)
     def broadcastRoute():
 
-        text = request.get_json()["msg"]
+        body = request.get_json()
+
+        try:
+            job = BroadcastHandler.createJob(
+                telegramApi, body["msg"], body.get("filters"), "wait" in request.args
+            )
+        except ValueError as e:
+            return str(e), 400
+
+        return jsonify(job.toDict())
+
+    # Reports the progress of a broadcast
+    @app.route(getRouteUrl("broadcast/<int:jobId>"))
+    def broadcastStatusRoute(jobId):
+
+        job = BroadcastHandler.getJob(jobId)
+        if job is None:
+            return "Broadcast job not found", 404
+
+        return jsonify(job.toDict())
+
+    @app.route(getRouteUrl("broadcast/<int:jobId>/cancel"), methods=["POST"])
+    def broadcastCancelRoute(jobId):
+
+        job = BroadcastHandler.cancelJob(jobId)
+        if job is None:
+            return "Broadcast job not found", 404
+
+        return jsonify(job.toDict())
+
+    # Endpoint for Cloud scheduler to pick up broadcasts interrupted by an instance restart
+    @app.route(getRouteUrl("broadcast/resume"))
+    def broadcastResumeRoute():
 
-        with ndbClient.context():
-            return BroadcastHandler.broadcast(telegramApi, text)
+        resumed = BroadcastHandler.resumeJobs(telegramApi)
+        return f"Resumed {resumed} broadcast jobs"
 
     # Configures bot webhook
     @app.route(getRouteUrl("setWebhook"))
@@ -113,7 +290,7 @@ def create_app():
         projectUrl, botToken = SECRETS["project-url"], SECRETS["telegram-bot"]
         url = f"{projectUrl}/{botToken}/webhook"
 
-        resp = telegramApi.setWebhook(url)
+        resp = telegramApi.setWebhook(url, WebhookUpdate.ALLOWED_UPDATES)
         if resp["ok"]:
             return "Set webhook to: " + url
         else:
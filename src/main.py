@@ -0,0 +1,7 @@
+#
+#   Production WSGI entry point served by gunicorn (see gunicorn.conf.py)
+#
+
+from .app import create_app
+
+app = create_app()
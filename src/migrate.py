@@ -0,0 +1,238 @@
+#
+#   Bulk migration of legacy User (Client) entities
+#   Normalises legacy statuses, strips fields that are no longer used and rewrites
+#   the entities page by page across a bounded pool of greenlets
+#
+#   Progress is logged with the cursor after each page so an interrupted run can
+#   be resumed with --cursor
+#
+#   Usage: python -m src.migrate [--dry-run] [--page-size 200] [--concurrency 10]
+#
+
+from gevent import monkey
+
+monkey.patch_all()
+
+import json
+import logging
+import argparse
+from time import time
+from collections import Counter
+from datetime import datetime, timedelta
+from google.cloud import ndb, datastore
+
+from .model.user import User, UserState
+from .model.userStats import UserStats
+from .util.ndbClient import getNdbClient, withContext
+from .util.pagedQuery import iterPages
+from .util.trackedGroup import TrackedGroup
+
+logger = logging.getLogger(__name__)
+
+
+class UserMigration:
+
+    # Prefix of statuses set by the previous version while the website was offline
+    LEGACY_STATUS_PREFIX = "offline,"
+    # Temperature set by the previous version on reset
+    LEGACY_TEMP_INIT = "init"
+
+    # The group's members are only needed while the user is picking their name
+    ONBOARDING_STATES = [
+        UserState.INIT_CONFIRM_URL,
+        UserState.INIT_GET_NAME,
+        UserState.INIT_CONFIRM_NAME,
+    ]
+
+    def __init__(
+        self,
+        pageSize: int = 200,
+        concurrency: int = 10,
+        staleDays: int = 7,
+        dryRun: bool = False,
+        rewriteAll: bool = False,
+        recount: bool = False,
+    ):
+        self.pageSize = pageSize
+        self.concurrency = concurrency
+        # Users stuck in onboarding for longer than this are sent back to the start
+        self.staleBefore = datetime.utcnow() - timedelta(days=staleDays)
+        self.dryRun = dryRun
+        # Rewrite unchanged entities too (e.g. after adding a property with a default)
+        self.rewriteAll = rewriteAll
+        # Recompute the user stats counters from the migrated entities
+        self.recount = recount
+
+        # Raw view of the stored entities, created on first use
+        self._datastore = None
+
+    # Names of stored properties that are no longer in the model, by user ID
+    # NDB drops them when loading a User, so they are read from the raw entities
+    def staleProperties(self, keys: list) -> dict:
+
+        if self._datastore is None:
+            ndbClient = getNdbClient()
+            self._datastore = datastore.Client(
+                project=ndbClient.project, namespace=ndbClient.namespace
+            )
+
+        rawKeys = [self._datastore.key(x.kind(), x.id()) for x in keys]
+        return {
+            x.key.id_or_name: [name for name in x if name not in User._properties]
+            for x in self._datastore.get_multi(rawKeys)
+        }
+
+    # Migrates a user in place
+    # staleProperties are the stored properties that are no longer in the model, which
+    # are removed by writing the user back
+    # Returns the names of the changes made
+    def migrateUser(self, user: User, staleProperties: list = ()) -> list:
+
+        changes = [f"removed {name}" for name in staleProperties]
+
+        if user.status and user.status.startswith(self.LEGACY_STATUS_PREFIX):
+            user.status = user.status[len(self.LEGACY_STATUS_PREFIX) :]
+            changes.append("status")
+
+        if user.temp == self.LEGACY_TEMP_INIT:
+            user.temp = None
+            changes.append("temp")
+
+        if user.status in self.ONBOARDING_STATES:
+            # lastActive is unknown for users that haven't been active since it was
+            # added, so they are kept as they are
+            if user.lastActive is not None and user.lastActive < self.staleBefore:
+                blocked = user.blocked
+                user.reset()
+                user.blocked = blocked
+                changes.append("stale onboarding")
+
+        elif user.groupMembers is not None:
+            user.groupMembers = None
+            changes.append("groupMembers")
+
+        return changes
+
+    # Migrates one page of users in a transaction so concurrent updates by the
+    # users themselves aren't overwritten
+    # Returns the number of users, the changes made and the stats of the users
+    @withContext
+    def migratePage(self, keys: list) -> tuple:
+
+        stale = self.staleProperties(keys)
+
+        @ndb.transactional()
+        def migrate():
+            changes = Counter()
+            stats = Counter()
+            statsDeltas = Counter()
+            modified = []
+
+            users = [x for x in ndb.get_multi(keys, use_cache=False) if x is not None]
+            for user in users:
+
+                before = UserStats.snapshot(user)
+                userChanges = self.migrateUser(user, stale.get(user.key.id(), []))
+                after = UserStats.snapshot(user)
+
+                changes.update(userChanges)
+                stats.update(UserStats.diff(None, after))
+
+                if userChanges or self.rewriteAll:
+                    modified.append(user)
+                    statsDeltas.update(UserStats.diff(before, after))
+
+            if not self.dryRun:
+                ndb.put_multi(modified, use_cache=False)
+                if not self.recount:
+                    UserStats.apply(statsDeltas)
+
+            changes["modified"] = len(modified)
+            return len(users), changes, stats
+
+        return migrate()
+
+    # Pages are migrated concurrently but their results are collected in order, so
+    # the logged cursor is only ever past pages that have been fully migrated
+    def run(self, startCursor: ndb.Cursor = None) -> dict:
+
+        start = time()
+        total = 0
+        changes = Counter()
+        stats = Counter()
+
+        with getNdbClient().context():
+
+            pages = iterPages(
+                User.query(), self.pageSize, startCursor, keys_only=True
+            )
+            cursors = []
+
+            def keys():
+                for results, cursor, _ in pages:
+                    cursors.append(cursor)
+                    yield results
+
+            pool = TrackedGroup()
+            for idx, (count, pageChanges, pageStats) in enumerate(
+                pool.imap(self.migratePage, keys(), maxsize=self.concurrency)
+            ):
+                total += count
+                changes.update(pageChanges)
+                stats.update(pageStats)
+
+                cursor = cursors[idx]
+                logger.info(
+                    f"Migrated {total} users ({total / (time() - start):.2f}/s), "
+                    f"cursor: {cursor.urlsafe().decode() if cursor else None}"
+                )
+
+            # Counters can only be recounted from a full walk
+            if self.recount and not self.dryRun and startCursor is None:
+                UserStats.reset(stats)
+
+        elapsedTime = time() - start
+
+        return {
+            "dryRun": self.dryRun,
+            "total": total,
+            "changes": dict(changes),
+            "stats": dict(stats),
+            "elapsedTime": round(elapsedTime, 2),
+            "rate": round(total / elapsedTime, 2) if elapsedTime else 0,
+        }
+
+
+if __name__ == "__main__":
+
+    logging.basicConfig(level=logging.INFO)
+
+    parser = argparse.ArgumentParser(description="Migrate legacy User entities")
+    parser.add_argument("--dry-run", action="store_true", help="Don't write changes")
+    parser.add_argument("--page-size", type=int, default=200)
+    parser.add_argument("--concurrency", type=int, default=10)
+    parser.add_argument(
+        "--stale-days",
+        type=int,
+        default=7,
+        help="Restart onboarding for users last active more than this many days ago",
+    )
+    parser.add_argument(
+        "--all", action="store_true", help="Rewrite entities that are unchanged"
+    )
+    parser.add_argument(
+        "--recount", action="store_true", help="Recompute the user stats counters"
+    )
+    parser.add_argument("--cursor", help="Resume from a cursor logged by a past run")
+    args = parser.parse_args()
+
+    migration = UserMigration(
+        pageSize=args.page_size,
+        concurrency=args.concurrency,
+        staleDays=args.stale_days,
+        dryRun=args.dry_run,
+        rewriteAll=args.all,
+        recount=args.recount,
+    )
+    report = migration.run(ndb.Cursor(urlsafe=args.cursor) if args.cursor else None)
+    print(json.dumps(report, indent=2))
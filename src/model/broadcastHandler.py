@@ -1,78 +1,350 @@
-import asyncio
 import logging
 from time import time
-from gevent.pool import Group
+from collections import Counter
+from datetime import datetime, timedelta
+from google.cloud import ndb
 
 logger = logging.getLogger(__name__)
 
 from ..model.user import User
+from ..model.broadcastJob import BroadcastJob, BroadcastJobStatus
+from ..model.userStats import UserStats
 from ..util.telegramWrapper import TelegramApiWrapper
+from ..util.ndbClient import withContext
+from ..util.pagedQuery import iterPages
+from ..util.messageTemplate import MessageTemplate
+from ..util.trackedGroup import TrackedGroup
+from ..util.fanoutCollector import FanoutCollector
 
 
 class BroadcastHandler:
+
+    SUCCESS = FanoutCollector.SUCCESS
+    FAILED = FanoutCollector.FAILED
+    BLOCKED = FanoutCollector.BLOCKED
+
+    # Number of recipients fetched and sent before progress is saved
+    PAGE_SIZE = 500
+    # Maximum number of messages being sent at once
+    CONCURRENCY = 100
+
+    # Jobs running on this instance
+    jobPool = TrackedGroup()
+
+    # Filters that can be applied to the recipients of a broadcast and their types
+    # All filters map onto indexed properties (see index.yaml)
+    FILTERS = {
+        "groupId": str,
+        "status": str,
+        "remindAM": int,
+        "remindPM": int,
+        # Only send to users that were active in the last number of days
+        "activeWithinDays": int,
+    }
+
+    # Raises ValueError if the filters are not valid
+    @classmethod
+    def validateFilters(cls, filters: dict):
+
+        if not isinstance(filters, dict):
+            raise ValueError("Filters must be an object")
+
+        for name, value in filters.items():
+            if name not in cls.FILTERS:
+                raise ValueError(f"Unknown filter: {name}")
+            if not isinstance(value, cls.FILTERS[name]) or isinstance(value, bool):
+                raise ValueError(f"Invalid value for filter {name}: {value}")
+
+    # Builds the query for recipients of a broadcast
     @classmethod
-    def broadcast(cls, telegramApi: TelegramApiWrapper, text: str) -> str:
+    def makeQuery(cls, filters: dict = None) -> ndb.Query:
 
         # Fetch users that aren't blocked
-        allUserKeys = User.query(User.blocked == False).fetch(keys_only=True)
-        # If the User keys are passed in, the gevent coroutines will be sharing the same
-        # NDB context and conflict
-        allUserIds = [x.id() for x in allUserKeys]
-
-        SUCCESS = 0
-        FAILED = 1
-        BLOCKED = -1
-
-        def sendMessage(chatId):
-
-            # Create message payload
-            payload = {
-                "chat_id": str(chatId),
-                "text": text,
-                "parse_mode": "HTML",
-            }
-
-            try:
-                resp = telegramApi.sendMessage(payload)
-
-                if resp["ok"]:
-                    return (chatId, SUCCESS)
-                else:
-                    if resp["error_code"] == 403:
-                        # User blocked bot
-                        return (chatId, BLOCKED)
+        query = User.query(User.blocked == False)
+
+        for name, value in (filters or {}).items():
+            if name == "activeWithinDays":
+                cutoff = datetime.utcnow() - timedelta(days=value)
+                query = query.filter(User.lastActive >= cutoff)
+            else:
+                query = query.filter(getattr(User, name) == value)
+
+        return query
+
+    # Returns the chat ID, status of the message and its (error code, description)
+    @classmethod
+    def sendMessage(cls, telegramApi: TelegramApiWrapper, chatId, text: str):
+
+        # Create message payload
+        payload = {
+            "chat_id": str(chatId),
+            "text": text,
+            "parse_mode": "HTML",
+        }
+
+        try:
+            resp = telegramApi.sendMessage(payload)
+
+            if resp["ok"]:
+                return (chatId, cls.SUCCESS, None)
+
+            error = (resp["error_code"], resp["description"])
+            if resp["error_code"] == 403:
+                # User blocked bot
+                return (chatId, cls.BLOCKED, error)
+            else:
+                # Errors are counted by the collector instead of logged one by one
+                return (chatId, cls.FAILED, error)
+
+        except Exception as e:
+            logger.debug(e)
+            return (chatId, cls.FAILED, (None, type(e).__name__))
+
+    # Marks users that blocked the bot so they are excluded from later messages
+    # Returns the changes to user stats
+    @classmethod
+    def markBlocked(cls, chatIds: list) -> Counter:
+
+        deltas = Counter()
+        users = ndb.get_multi([ndb.Key(User, x) for x in chatIds], use_cache=False)
+        users = [x for x in users if x is not None and not x.blocked]
+
+        for user in users:
+            before = UserStats.snapshot(user)
+            user.reset()
+            user.blocked = True
+            deltas.update(UserStats.diff(before, UserStats.snapshot(user)))
+
+        ndb.put_multi(users, use_cache=False)
+        return deltas
+
+    # Creates a broadcast job and starts sending it in the background
+    # If wait is set, returns only once the job is finished (e.g. for profiling)
+    @classmethod
+    def createJob(
+        cls,
+        telegramApi: TelegramApiWrapper,
+        text: str,
+        filters: dict = None,
+        wait: bool = False,
+    ) -> BroadcastJob:
+
+        if filters:
+            cls.validateFilters(filters)
+
+        job = BroadcastJob(text=text, filters=filters or None)
+        job.renewLease()
+        job.put()
+
+        greenlet = cls.jobPool.spawn(cls.runJob, telegramApi, job.key)
+
+        if wait:
+            greenlet.join()
+            job = job.key.get(use_cache=False)
+
+        return job
+
+    @classmethod
+    def getJob(cls, jobId: int) -> BroadcastJob:
+        return BroadcastJob.get_by_id(jobId)
+
+    # Stops sending further pages of a job
+    @classmethod
+    @ndb.transactional()
+    def cancelJob(cls, jobId: int) -> BroadcastJob:
+
+        job = BroadcastJob.get_by_id(jobId)
+        if job is not None and job.isActive():
+            job.status = BroadcastJobStatus.CANCELLED
+            job.finished = datetime.utcnow()
+            job.leaseExpiry = None
+            job.put()
+
+        return job
+
+    # Restarts jobs whose instance stopped renewing their lease (e.g. after a restart)
+    # Returns the number of jobs resumed
+    @classmethod
+    def resumeJobs(cls, telegramApi: TelegramApiWrapper) -> int:
+
+        @ndb.transactional()
+        def claim(jobKey: ndb.Key) -> bool:
+            job = jobKey.get()
+            if not job.isActive() or job.isLeased():
+                return False
+
+            job.renewLease()
+            job.put()
+            return True
+
+        # Finished jobs have no lease and are excluded by the lower bound
+        query = BroadcastJob.query(
+            BroadcastJob.leaseExpiry > datetime.utcfromtimestamp(0),
+            BroadcastJob.leaseExpiry < datetime.utcnow(),
+        )
+
+        resumed = 0
+        for jobKey in query.fetch(keys_only=True):
+
+            if claim(jobKey):
+                logger.info(f"Resuming broadcast job {jobKey.id()}")
+                cls.jobPool.spawn(cls.runJob, telegramApi, jobKey)
+                resumed += 1
+
+        return resumed
+
+    # Jobs that raise (e.g. a query missing its index) are marked as failed instead
+    # of being left leased and resumed again and again
+    @classmethod
+    @withContext
+    def runJob(cls, telegramApi: TelegramApiWrapper, jobKey: ndb.Key):
+
+        try:
+            return cls.sendJob(telegramApi, jobKey)
+        except Exception as e:
+            logger.exception(f"Broadcast job {jobKey.id()} failed")
+            cls.failJob(jobKey, str(e))
+            return f"Broadcast job {jobKey.id()} failed: {e}"
+
+    @classmethod
+    @ndb.transactional()
+    def failJob(cls, jobKey: ndb.Key, error: str):
+
+        job: BroadcastJob = jobKey.get()
+        if job.isActive():
+            job.status = BroadcastJobStatus.FAILED
+            job.error = error
+            job.finished = datetime.utcnow()
+            job.leaseExpiry = None
+            job.put()
+
+    # Streams recipients into the send pool page by page as they are fetched
+    # Progress is saved whenever all pages up to some point have been sent, so
+    # messages from partially sent pages may be sent again when the job resumes
+    @classmethod
+    def sendJob(cls, telegramApi: TelegramApiWrapper, jobKey: ndb.Key):
+
+        job: BroadcastJob = jobKey.get()
+
+        if not job.isActive():
+            return f"Broadcast job {jobKey.id()} is already {job.status}"
+
+        if job.status == BroadcastJobStatus.PENDING:
+            job.status = BroadcastJobStatus.RUNNING
+            job.started = datetime.utcnow()
+
+        logger.info(f"Starting broadcast job {jobKey.id()}")
+
+        query = cls.makeQuery(job.filters)
+        startCursor = ndb.Cursor(urlsafe=job.cursor) if job.cursor else None
+
+        # Personalised messages need the User entities, which are fetched together
+        # with each page instead of individually by every greenlet
+        template = MessageTemplate(job.text)
+        keysOnly = template.isStatic()
+        staticText = template.render() if keysOnly else None
+
+        # Page index -> cursor after the page
+        pageCursors = {}
+        # Page index -> number of messages in the page not yet sent
+        pageRemaining = {}
+
+        def recipients():
+            pages = iterPages(query, cls.PAGE_SIZE, startCursor, keys_only=keysOnly)
+            for idx, (results, cursor, _) in enumerate(pages):
+                pageCursors[idx] = cursor
+                pageRemaining[idx] = len(results)
+
+                # If the User keys are passed in, the gevent coroutines will be sharing
+                # the same NDB context and conflict
+                for result in results:
+                    if keysOnly:
+                        yield (idx, result.id(), staticText)
                     else:
-                        return (chatId, FAILED)
-                        logger.error(resp["description"])
+                        yield (idx, result.key.id(), template.render(result))
+
+        def sendMessage(recipient):
+            idx, chatId, text = recipient
+
+            sendStart = time()
+            result = cls.sendMessage(telegramApi, chatId, text)
+            return (idx, time() - sendStart) + result
+
+        # Results of the whole run on this instance, and results and users that
+        # blocked the bot since the last checkpoint
+        collector = FanoutCollector(["sendDuration"])
+        segment = FanoutCollector(["sendDuration"])
+        blockedIds = []
+
+        # Save progress unless the job was cancelled in the meantime
+        def checkpoint(cursor: ndb.Cursor, isDone: bool) -> BroadcastJob:
+            if blockedIds:
+                UserStats.apply(cls.markBlocked(blockedIds))
+
+            collector.merge(segment)
+            return saveProgress(cursor, isDone)
+
+        @ndb.transactional()
+        def saveProgress(cursor: ndb.Cursor, isDone: bool) -> BroadcastJob:
+            current: BroadcastJob = jobKey.get()
+            current.sent += segment.count(cls.SUCCESS)
+            current.failed += segment.count(cls.FAILED)
+            current.blocked += segment.count(cls.BLOCKED)
+            current.addErrors(segment.errorCodes, segment.errors)
+            current.started = current.started or job.started
+
+            if current.status != BroadcastJobStatus.CANCELLED:
+                current.status = BroadcastJobStatus.RUNNING
+                current.cursor = cursor.urlsafe().decode() if cursor else None
+                current.renewLease()
+
+                if isDone:
+                    current.status = BroadcastJobStatus.DONE
+                    current.finished = datetime.utcnow()
+                    current.leaseExpiry = None
+                    timings = collector.summary()["timings"]
+                    current.sendDuration = timings["sendDuration"]
+
+            current.put()
+            return current
+
+        pool = TrackedGroup()
+        respList = pool.imap_unordered(
+            sendMessage, recipients(), maxsize=cls.CONCURRENCY
+        )
+
+        # Index of the last page that has been completely sent
+        lastSentPage = -1
+        lastCheckpointPage = -1
 
-            except Exception as e:
-                logger.error(e)
-                return (chatId, FAILED)
+        for idx, sendDuration, chatId, status, error in respList:
+            segment.add(status, error, sendDuration=sendDuration)
+            if status == cls.BLOCKED:
+                blockedIds.append(chatId)
 
-        logger.info("Starting broadcast")
+            pageRemaining[idx] -= 1
+            while pageRemaining.get(lastSentPage + 1) == 0:
+                lastSentPage += 1
 
-        start = time()
+            if lastSentPage > lastCheckpointPage:
+                job = checkpoint(pageCursors[lastSentPage], False)
+                lastCheckpointPage = lastSentPage
+                segment = FanoutCollector(["sendDuration"])
+                blockedIds = []
 
-        pool = Group()
-        respList = pool.imap_unordered(sendMessage, allUserIds, maxsize=100)
+                if job.status == BroadcastJobStatus.CANCELLED:
+                    respList.kill()
+                    pool.kill()
+                    break
 
-        # Count statuses of broadcast
-        success, failed, blocked = 0, 0, 0
-        blockedUsers = []
-        for resp in respList:
-            if resp[1] == SUCCESS:
-                success += 1
-            elif resp[1] == FAILED:
-                failed += 1
-            elif resp[1] == BLOCKED:
-                blocked += 1
-                # TODO Set user status to blocked
-                blockedUsers.append(resp[0])
+        if job.status != BroadcastJobStatus.CANCELLED:
+            job = checkpoint(None, True)
 
-        elapsedTime = time() - start
-        rate = len(allUserKeys) / elapsedTime
+        summary = collector.summary()
 
-        logStr = f"Broadcast sent to {len(allUserKeys)} clients in {elapsedTime:.4f}s ({rate:.2f}/s). Successes: {success}, blocked: {blocked}, failures: {failed}"
+        logStr = f"Broadcast job {jobKey.id()} sent to {summary['total']} clients in {summary['elapsedTime']:.4f}s ({summary['rate']:.2f}/s). Successes: {job.sent}, blocked: {job.blocked}, failures: {job.failed}"
+        if job.errorCodes:
+            logStr += f". Errors: {job.errorCodes}"
 
         logger.info(logStr)
         return logStr
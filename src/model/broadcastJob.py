@@ -0,0 +1,94 @@
+#
+#   Cloud NDB entity for tracking the progress of a broadcast
+#
+
+from datetime import datetime, timedelta
+from collections import Counter
+from google.cloud import ndb
+
+from ..util.fanoutCollector import FanoutCollector
+
+
+class BroadcastJobStatus:
+    PENDING = "pending"
+    RUNNING = "running"
+    DONE = "done"
+    CANCELLED = "cancelled"
+    # Stopped by an error that would recur if the job was resumed
+    FAILED = "failed"
+
+
+class BroadcastJob(ndb.Model):
+
+    text = ndb.TextProperty()
+    # Restricts the recipients of the broadcast (see BroadcastHandler.FILTERS)
+    filters = ndb.JsonProperty()
+    status = ndb.StringProperty(default=BroadcastJobStatus.PENDING)
+
+    # Reason the job failed
+    error = ndb.StringProperty(indexed=False)
+
+    # Query cursor of the next page of recipients to be sent
+    cursor = ndb.StringProperty(indexed=False)
+
+    sent = ndb.IntegerProperty(default=0, indexed=False)
+    failed = ndb.IntegerProperty(default=0, indexed=False)
+    blocked = ndb.IntegerProperty(default=0, indexed=False)
+
+    # Failed messages by error code and by Telegram's error description
+    errorCodes = ndb.JsonProperty()
+    errors = ndb.JsonProperty()
+    # Percentile summary of the time taken by Telegram to accept each message
+    # (see util.stats.summarise), covering the last instance to run the job
+    sendDuration = ndb.JsonProperty()
+
+    created = ndb.DateTimeProperty(auto_now_add=True)
+    started = ndb.DateTimeProperty(indexed=False)
+    finished = ndb.DateTimeProperty(indexed=False)
+
+    # The instance running the job renews this after every page
+    # Jobs with an expired lease are picked up again by another instance
+    leaseExpiry = ndb.DateTimeProperty()
+    LEASE_DURATION = timedelta(minutes=2)
+
+    def isLeased(self) -> bool:
+        return self.leaseExpiry is not None and self.leaseExpiry > datetime.utcnow()
+
+    def renewLease(self):
+        self.leaseExpiry = datetime.utcnow() + self.LEASE_DURATION
+
+    def addErrors(self, errorCodes: dict, errors: dict):
+        self.errorCodes = dict(Counter(self.errorCodes) + Counter(errorCodes))
+        allErrors = Counter(self.errors)
+        FanoutCollector.addErrorCounts(allErrors, errors)
+        self.errors = dict(allErrors)
+
+    def isActive(self) -> bool:
+        return self.status in [BroadcastJobStatus.PENDING, BroadcastJobStatus.RUNNING]
+
+    def toDict(self) -> dict:
+
+        total = self.sent + self.failed + self.blocked
+
+        rate = 0
+        if self.started:
+            end = self.finished or datetime.utcnow()
+            elapsedTime = (end - self.started).total_seconds()
+            rate = total / elapsedTime if elapsedTime > 0 else 0
+
+        return {
+            "id": self.key.id(),
+            "status": self.status,
+            "error": self.error,
+            "filters": self.filters,
+            "sent": self.sent,
+            "failed": self.failed,
+            "blocked": self.blocked,
+            "rate": round(rate, 2),
+            "errorCodes": self.errorCodes or {},
+            "errors": self.errors or {},
+            "sendDuration": self.sendDuration,
+            "created": self.created.isoformat() if self.created else None,
+            "started": self.started.isoformat() if self.started else None,
+            "finished": self.finished.isoformat() if self.finished else None,
+        }
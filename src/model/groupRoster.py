@@ -0,0 +1,31 @@
+#
+#   Cloud NDB entity caching the members of a temptaking group
+#   The entity ID is the group ID
+#
+
+from datetime import datetime, timedelta
+from google.cloud import ndb
+
+
+class GroupRoster(ndb.Model):
+
+    groupName = ndb.StringProperty(indexed=False)
+    # Members as returned by the website: {"id", "identifier", "hasPin"}
+    members = ndb.JsonProperty(compressed=True)
+    refreshed = ndb.DateTimeProperty(indexed=False)
+
+    def isFresh(self, maxAge: timedelta) -> bool:
+        return self.refreshed is not None and datetime.utcnow() - self.refreshed < maxAge
+
+    # Returns the member with the given ID, or None if they left the group
+    def member(self, memberId: str) -> dict:
+        for x in self.members or []:
+            if x["id"] == memberId:
+                return x
+
+        return None
+
+    # Members whose name or PIN changed since the given roster, by ID
+    def changedSince(self, previous: "GroupRoster") -> dict:
+        before = {x["id"]: x for x in previous.members or []} if previous else {}
+        return {x["id"]: x for x in self.members or [] if before.get(x["id"]) != x}
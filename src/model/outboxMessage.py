@@ -0,0 +1,34 @@
+#
+#   Cloud NDB entity for webhook replies waiting to be sent again
+#
+
+from datetime import datetime, timedelta
+from google.cloud import ndb
+
+
+class OutboxMessage(ndb.Model):
+
+    # sendMessage payload
+    payload = ndb.JsonProperty()
+
+    attempts = ndb.IntegerProperty(default=0, indexed=False)
+    lastError = ndb.StringProperty(indexed=False)
+
+    created = ndb.DateTimeProperty(auto_now_add=True, indexed=False)
+    # The message isn't retried before this time
+    nextAttempt = ndb.DateTimeProperty()
+
+    # Messages that are due to be retried, oldest first
+    @classmethod
+    def due(cls, limit: int) -> list:
+        query = cls.query(cls.nextAttempt <= datetime.utcnow())
+        return query.order(cls.nextAttempt).fetch(limit, keys_only=True)
+
+    @classmethod
+    def fromRetry(cls, payload: dict, attempts: int, lastError: str, delay: float):
+        return cls(
+            payload=payload,
+            attempts=attempts,
+            lastError=lastError,
+            nextAttempt=datetime.utcnow() + timedelta(seconds=delay),
+        )
@@ -1,27 +1,39 @@
-import asyncio
 import logging
+import gevent
 from time import time
-from gevent.pool import Group
-from google.cloud import ndb
+from datetime import timedelta
+from collections import Counter
 
 logger = logging.getLogger(__name__)
 
 from ..stringConstants import StringConstants
 
 from ..model.user import User, UserState
+from ..model.reminderRun import ReminderRun
+from ..model.userStats import UserStats
 from ..model.telegramMarkup import TelegramMarkup
 from ..util.telegramWrapper import TelegramApiWrapper
 from ..util.fmtDateTime import FmtDateTime
+from ..util.ndbClient import withContext
+from ..util.pagedQuery import iterPages
+from ..util.fanoutCollector import FanoutCollector
+from ..util.trackedGroup import TrackedGroup
 
 STRINGS = StringConstants().STRINGS
 
 
 class ReminderHandler:
 
-    ndbClient = ndb.Client()
+    # Number of recipients fetched from Datastore at a time
+    PAGE_SIZE = 500
+    # Number of times a message is retried when Telegram rate limits us
+    MAX_RETRIES = 3
 
+    # With a reminder window (see User.REMIND_WINDOW), this is called once for every
+    # minute in the window and only reminds users assigned to that minute
+    # The offset from HH:01 is taken from the current time if not given
     @classmethod
-    def remind(cls, telegramApi: TelegramApiWrapper) -> str:
+    def remind(cls, telegramApi: TelegramApiWrapper, offset: int = None) -> str:
 
         now = FmtDateTime.now()
         hour = now.dateObj.hour
@@ -30,87 +42,161 @@ class ReminderHandler:
 
         # Fetch users that aren't blocked and have reminders set
         if now.meridies == "AM":
-            allUserKeys = User.query(
+            query = User.query(
                 User.blocked == False, User.remindAM == hour, User.temp == "none"
-            ).fetch(keys_only=True)
+            )
 
         else:
-            allUserKeys = User.query(
+            query = User.query(
                 User.blocked == False, User.remindPM == hour, User.temp == "none"
-            ).fetch(keys_only=True)
+            )
+
+        if User.REMIND_WINDOW > 1:
+            if offset is None:
+                offset = now.dateObj.minute - 1
+
+            if offset not in range(User.REMIND_WINDOW):
+                return f"No reminders are sent at offset {offset}"
+
+        # Reminders are due at HH:01 plus the offset; the time is taken relative to now
+        # as dateObj is shifted to local time
+        hourStart = now.dateObj.replace(minute=0, second=0, microsecond=0)
+        scheduled = hourStart + timedelta(minutes=1 + (offset or 0))
+        scheduledAt = time() - (now.dateObj - scheduled).total_seconds()
+
+        # Recipients are streamed into the pool as pages arrive so sending starts
+        # immediately and only a few pages are held in memory at a time
+        # Each recipient is paired with the time its page was fetched to measure
+        # queueing
+        def fetchRecipients():
+            for userKeys, _, _ in iterPages(query, cls.PAGE_SIZE, keys_only=True):
+                fetchedAt = time()
+
+                for userKey in userKeys:
+                    # The minute is derived from the chat ID, so keys are filtered here
+                    # instead of by a stored property that goes stale when the window
+                    # changes
+                    if User.REMIND_WINDOW > 1:
+                        if User.remindOffsetFor(userKey.id()) != offset:
+                            continue
+
+                    yield userKey, fetchedAt
 
         text = STRINGS["window_open"].format(
             now.time, now.dayOfWeek, now.shortDate, now.meridies
         )
 
-        SUCCESS = 0
-        FAILED = 1
-        BLOCKED = -1
+        SUCCESS = FanoutCollector.SUCCESS
+        FAILED = FanoutCollector.FAILED
+        BLOCKED = FanoutCollector.BLOCKED
 
-        def sendMessage(userKey: ndb.Key):
-
-            # gevent somehow messes with the ndb context even though it's the same thread
-            with cls.ndbClient.context():
-                # Create message payload
-                payload = {
-                    "chat_id": str(userKey.id()),
-                    "text": text,
-                    "parse_mode": "HTML",
-                    "reply_markup": TelegramMarkup.TemperatureKeyboard,
-                }
-
-                user: User = userKey.get()
+        collector = FanoutCollector(["queueLag", "sendDuration", "deliveryLag"])
 
+        # Sends the message, retrying if Telegram rate limits us
+        # Returns the response and number of retries
+        def trySend(payload):
+            retries = 0
+            while True:
                 try:
                     resp = telegramApi.sendMessage(payload)
-
-                    # User statuses have to be updated right after sending or user may hit an invalid state
-                    # when they report their temperature
-                    if resp["ok"]:
-                        user.temp = User.TEMP_NONE
-                        user.status = UserState.TEMP_REPORT
-                        user.put()
-
-                        return SUCCESS
-
-                    else:
-                        if (
-                            resp["description"]
-                            == "Forbidden: bot was blocked by the user"
-                        ):
-
-                            user.reset()
-                            user.blocked = True
-                            user.put()
-
-                            return BLOCKED
-                        else:
-                            return FAILED
-                            logger.error(resp["description"])
-
                 except Exception as e:
-                    logger.error(e)
-                    return FAILED
-
-        start = time()
-
-        pool = Group()
-        respList = pool.imap_unordered(sendMessage, allUserKeys, maxsize=100)
-
-        # Count statuses of reminder
-        success, failed, blocked = 0, 0, 0
-        for resp in respList:
-            if resp == SUCCESS:
-                success += 1
-            elif resp == FAILED:
-                failed += 1
-            elif resp == BLOCKED:
-                blocked += 1
-
-        elapsedTime = time() - start
-        rate = len(allUserKeys) / elapsedTime
-
-        logStr = f"Reminder sent to {len(allUserKeys)} clients in {elapsedTime:.4f}s ({rate:.2f}/s). Successes: {success}, blocked: {blocked}, failures: {failed}"
+                    # Counted by the collector as a network error
+                    logger.debug(e)
+                    resp = {"ok": False, "description": type(e).__name__}
+
+                if resp["ok"] or retries >= cls.MAX_RETRIES:
+                    return resp, retries
+
+                if resp.get("error_code") == 429:
+                    retryAfter = resp.get("parameters", {}).get("retry_after", 1)
+                elif "error_code" not in resp:
+                    # Request failed without reaching Telegram
+                    retryAfter = 2 ** retries
+                else:
+                    return resp, retries
+
+                retries += 1
+                gevent.sleep(retryAfter)
+
+        # Greenlets can't see the request's context, so each one borrows an idle one
+        # Returns the status of the message, its error, number of retries, timings and
+        # the changes to user stats
+        @withContext
+        def sendMessage(recipient):
+
+            userKey, fetchedAt = recipient
+
+            # Create message payload
+            payload = {
+                "chat_id": str(userKey.id()),
+                "text": text,
+                "parse_mode": "HTML",
+                "reply_markup": TelegramMarkup.TemperatureKeyboard,
+            }
+
+            sendStart = time()
+            resp, retries = trySend(payload)
+            sendEnd = time()
+
+            timings = {
+                "queueLag": sendStart - fetchedAt,
+                "sendDuration": sendEnd - sendStart,
+            }
+
+            # Only the key is needed to send the message, so the full entity is read
+            # after sending and only if it has to be updated
+            # The entity is read once per run, so it isn't kept in the context cache
+
+            # User statuses have to be updated right after sending or user may hit an invalid state
+            # when they report their temperature
+            if resp["ok"]:
+                user: User = userKey.get(use_cache=False)
+                before = UserStats.snapshot(user)
+                user.temp = User.TEMP_NONE
+                user.status = UserState.TEMP_REPORT
+                user.put(use_cache=False)
+
+                deltas = UserStats.diff(before, UserStats.snapshot(user))
+                timings["deliveryLag"] = sendEnd - scheduledAt
+                return (SUCCESS, None, retries, timings, deltas)
+
+            else:
+                error = (resp.get("error_code"), resp["description"])
+
+                if resp["description"] == "Forbidden: bot was blocked by the user":
+
+                    user: User = userKey.get(use_cache=False)
+                    before = UserStats.snapshot(user)
+                    user.reset()
+                    user.blocked = True
+                    user.put(use_cache=False)
+
+                    deltas = UserStats.diff(before, UserStats.snapshot(user))
+                    return (BLOCKED, error, retries, timings, deltas)
+                else:
+                    # Errors are counted by the collector instead of logged one by one
+                    return (FAILED, error, retries, timings, Counter())
+
+        pool = TrackedGroup()
+        respList = pool.imap_unordered(sendMessage, fetchRecipients(), maxsize=100)
+
+        statsDeltas = Counter()
+        for status, error, retries, timings, deltas in respList:
+            collector.add(status, error, retries, **timings)
+            statsDeltas.update(deltas)
+
+        # Stats are updated once for the whole run instead of by every greenlet
+        UserStats.apply(statsDeltas)
+
+        summary = collector.summary()
+        ReminderRun.fromSummary(
+            summary, meridies=now.meridies, hour=hour, offset=offset
+        ).put()
+
+        deliveryLag = summary["timings"]["deliveryLag"]
+        logStr = f"Reminder sent to {summary['total']} clients in {summary['elapsedTime']:.4f}s ({summary['rate']:.2f}/s). Successes: {summary['success']}, blocked: {summary['blocked']}, failures: {summary['failed']}, retries: {summary['retries']}. Delivery lag p50: {deliveryLag['p50']:.2f}s, p99: {deliveryLag['p99']:.2f}s"
+        if summary["errorCodes"]:
+            logStr += f". Errors: {summary['errorCodes']}"
 
         logger.info(logStr)
         return logStr
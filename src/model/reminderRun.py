@@ -0,0 +1,75 @@
+#
+#   Cloud NDB entity recording the delivery timings of a reminder run
+#
+
+from google.cloud import ndb
+
+
+class ReminderRun(ndb.Model):
+
+    started = ndb.DateTimeProperty(auto_now_add=True)
+    meridies = ndb.StringProperty(indexed=False)
+    hour = ndb.IntegerProperty(indexed=False)
+    # Minute within the reminder window, if reminders are spread out
+    offset = ndb.IntegerProperty(indexed=False)
+
+    total = ndb.IntegerProperty(default=0, indexed=False)
+    success = ndb.IntegerProperty(default=0, indexed=False)
+    failed = ndb.IntegerProperty(default=0, indexed=False)
+    blocked = ndb.IntegerProperty(default=0, indexed=False)
+    retries = ndb.IntegerProperty(default=0, indexed=False)
+    elapsedTime = ndb.FloatProperty(indexed=False)
+
+    # Percentile summaries in seconds (see util.stats.summarise)
+    # Time between a recipient being fetched and its message being sent
+    queueLag = ndb.JsonProperty()
+    # Time taken by Telegram to accept the message, including retries
+    sendDuration = ndb.JsonProperty()
+    # Time between the scheduled reminder time (HH:01 plus the offset) and the message
+    # being delivered
+    deliveryLag = ndb.JsonProperty()
+
+    # Failed messages by error code and by Telegram's error description
+    errorCodes = ndb.JsonProperty()
+    errors = ndb.JsonProperty()
+
+    # Creates a run from the summary of a FanoutCollector
+    @classmethod
+    def fromSummary(cls, summary: dict, **kwargs) -> "ReminderRun":
+        return cls(
+            total=summary["total"],
+            success=summary["success"],
+            failed=summary["failed"],
+            blocked=summary["blocked"],
+            retries=summary["retries"],
+            elapsedTime=summary["elapsedTime"],
+            queueLag=summary["timings"]["queueLag"],
+            sendDuration=summary["timings"]["sendDuration"],
+            deliveryLag=summary["timings"]["deliveryLag"],
+            errorCodes=summary["errorCodes"],
+            errors=summary["errors"],
+            **kwargs,
+        )
+
+    @classmethod
+    def latest(cls, limit: int = 20) -> list:
+        return cls.query().order(-cls.started).fetch(limit)
+
+    def toDict(self) -> dict:
+        return {
+            "started": self.started.isoformat() if self.started else None,
+            "meridies": self.meridies,
+            "hour": self.hour,
+            "offset": self.offset,
+            "total": self.total,
+            "success": self.success,
+            "failed": self.failed,
+            "blocked": self.blocked,
+            "retries": self.retries,
+            "elapsedTime": self.elapsedTime,
+            "queueLag": self.queueLag,
+            "sendDuration": self.sendDuration,
+            "deliveryLag": self.deliveryLag,
+            "errorCodes": self.errorCodes,
+            "errors": self.errors,
+        }
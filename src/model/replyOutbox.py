@@ -0,0 +1,213 @@
+#
+#   Retries webhook replies that Telegram didn't accept
+#   Failed replies are kept in a bounded in-memory queue, which spills over to
+#   OutboxMessage entities, and are sent again by a background greenlet
+#
+
+import os
+import logging
+import itertools
+import gevent
+from heapq import heappush, heappop
+from time import monotonic
+from weakref import WeakSet
+from gevent.event import Event
+from gevent.pool import Pool
+from google.cloud import ndb
+
+logger = logging.getLogger(__name__)
+
+from ..model.outboxMessage import OutboxMessage
+from ..util.telegramWrapper import TelegramApiWrapper
+from ..util.ndbClient import withContext
+from ..util.rateLimiter import RateLimiter
+
+
+class ReplyOutbox:
+
+    # Replies kept in memory before they are written to Datastore
+    MAX_QUEUE = 1000
+    # Replies are dropped after this many failed attempts
+    MAX_ATTEMPTS = 8
+    # Seconds between retries, doubled after every attempt
+    MAX_BACKOFF = 60
+    # Seconds between checks for replies spilled to Datastore
+    POLL_INTERVAL = 10
+    # Seconds given to retries in flight before the rest are written to Datastore
+    PERSIST_TIMEOUT = 5
+    # Telegram allows around 30 messages per second across all chats, which is shared
+    # by every process sending replies (instances times workers per instance)
+    SENDERS = int(os.environ.get("OUTBOX_SENDERS", 1))
+    RATE = 30 / SENDERS
+    CONCURRENCY = 10
+
+    # Outboxes that may still have replies in memory
+    _active = WeakSet()
+
+    def __init__(self, telegramApi: TelegramApiWrapper):
+        self.telegramApi = telegramApi
+
+        # Heap of (due time, sequence number, payload, attempts, last error)
+        self.queue = []
+        self.sequence = itertools.count()
+        self.wakeup = Event()
+
+        self.limiter = RateLimiter(self.RATE, max(int(self.RATE), 1))
+        self.pool = Pool(self.CONCURRENCY)
+        # Started by startAll() once the worker has forked, or on first use, so that
+        # it isn't spawned in the master before forking
+        self.drainer = None
+
+        ReplyOutbox._active.add(self)
+
+    # Tries to send the reply once and queues it if Telegram couldn't take it
+    # Returns True if the reply was sent
+    def send(self, payload: dict) -> bool:
+
+        self.ensureDrainer()
+
+        retry = self.trySend(payload)
+        if retry is None:
+            return True
+
+        self.enqueue(payload, 1, *retry)
+        return False
+
+    # Returns None if the reply doesn't have to be retried, otherwise the number of
+    # seconds Telegram asked to wait (if any) and the error
+    def trySend(self, payload: dict):
+
+        try:
+            resp = self.telegramApi.sendMessage(payload)
+        except Exception as e:
+            # Timeouts and connection errors
+            return (None, str(e))
+
+        if resp.get("ok"):
+            return None
+
+        errorCode = resp.get("error_code", 0)
+        if errorCode == 429:
+            retryAfter = resp.get("parameters", {}).get("retry_after")
+            return (retryAfter, resp.get("description"))
+        elif errorCode >= 500:
+            return (None, resp.get("description"))
+
+        # Errors such as the user blocking the bot won't go away by retrying
+        logger.warning(f"Reply to {payload.get('chat_id')}: {resp.get('description')}")
+        return None
+
+    def enqueue(self, payload: dict, attempts: int, retryAfter, error: str):
+
+        if attempts >= self.MAX_ATTEMPTS:
+            logger.error(
+                f"Dropped reply to {payload.get('chat_id')} after {attempts} attempts: {error}"
+            )
+            return
+
+        delay = retryAfter or min(2 ** attempts, self.MAX_BACKOFF)
+
+        if len(self.queue) < self.MAX_QUEUE:
+            item = (monotonic() + delay, next(self.sequence), payload, attempts, error)
+            heappush(self.queue, item)
+            self.wakeup.set()
+        else:
+            self.spill([OutboxMessage.fromRetry(payload, attempts, error, delay)])
+
+    @withContext
+    def spill(self, messages: list):
+        ndb.put_multi(messages)
+        logger.warning(f"Spilled {len(messages)} replies to the outbox")
+
+    def ensureDrainer(self):
+        if self.drainer is None or self.drainer.dead:
+            self.drainer = gevent.spawn(self.drain)
+
+    def retry(self, payload: dict, attempts: int):
+        retry = self.trySend(payload)
+        if retry is not None:
+            self.enqueue(payload, attempts + 1, *retry)
+
+    # Moves replies due for a retry from Datastore into memory
+    # Each reply is deleted as it is claimed so that only one instance sends it
+    def loadSpilled(self):
+
+        @ndb.transactional()
+        def claim(key: ndb.Key) -> OutboxMessage:
+            message = key.get()
+            if message is not None:
+                key.delete()
+            return message
+
+        room = self.MAX_QUEUE - len(self.queue)
+        if room <= 0:
+            return
+
+        for key in OutboxMessage.due(min(room, 100)):
+            message = claim(key)
+            if message is not None:
+                item = (
+                    monotonic(),
+                    next(self.sequence),
+                    message.payload,
+                    message.attempts,
+                    message.lastError,
+                )
+                heappush(self.queue, item)
+
+    # Sends queued replies as they become due
+    @withContext
+    def drain(self):
+
+        lastPoll = 0
+        while True:
+
+            if monotonic() - lastPoll >= self.POLL_INTERVAL:
+                try:
+                    self.loadSpilled()
+                except Exception as e:
+                    logger.error(e)
+                lastPoll = monotonic()
+
+            waitTime = self.POLL_INTERVAL
+            if self.queue:
+                waitTime = min(self.queue[0][0] - monotonic(), waitTime)
+
+            if waitTime > 0:
+                self.wakeup.clear()
+                self.wakeup.wait(waitTime)
+                continue
+
+            _, _, payload, attempts, _ = heappop(self.queue)
+            self.limiter.acquire()
+            self.pool.spawn(self.retry, payload, attempts)
+
+    # Writes replies still in memory to Datastore, e.g. before the worker exits
+    @withContext
+    def persist(self):
+
+        if self.drainer is not None:
+            self.drainer.kill()
+        self.pool.join(timeout=self.PERSIST_TIMEOUT)
+
+        now = monotonic()
+        messages = [
+            OutboxMessage.fromRetry(payload, attempts, error, max(due - now, 0))
+            for due, _, payload, attempts, error in self.queue
+        ]
+        self.queue = []
+
+        if messages:
+            self.spill(messages)
+
+    # Starts sending replies left in Datastore, e.g. by a worker that exited, without
+    # waiting for new traffic
+    @classmethod
+    def startAll(cls):
+        for outbox in list(cls._active):
+            outbox.ensureDrainer()
+
+    @classmethod
+    def persistAll(cls):
+        for outbox in list(cls._active):
+            outbox.persist()
@@ -0,0 +1,174 @@
+#
+#   Keeps the stored rosters of temptaking groups and the users in them up to date
+#
+
+import logging
+from time import time
+from datetime import datetime, timedelta
+from google.cloud import ndb
+
+logger = logging.getLogger(__name__)
+
+from ..model.user import User
+from ..model.groupRoster import GroupRoster
+from ..util.temptakingWrapper import TemptakingWrapper
+from ..util.keyedLock import KeyedLock
+from ..util.ndbClient import withContext
+from ..util.pagedQuery import iterPages
+from ..util.trackedGroup import TrackedGroup
+
+
+class RosterHandler:
+
+    # Number of users of a group updated in a single transaction
+    PAGE_SIZE = 200
+    # Rosters younger than this are reused instead of loading the group again
+    MAX_AGE = timedelta(seconds=30)
+
+    # Concurrent loads of the same group within an instance share one request
+    groupLocks = KeyedLock()
+    # Users are repaired in the background so that webhook requests only wait for
+    # the roster
+    repairPool = TrackedGroup()
+
+    # Loads a group from the website and stores its roster
+    # Returns the roster and the stored roster it replaced, or None if the group
+    # couldn't be loaded
+    @classmethod
+    def refresh(cls, groupId: str):
+
+        ttWrapper = TemptakingWrapper.fromGroupId(groupId)
+        if not ttWrapper.load():
+            return None
+
+        roster = GroupRoster(
+            id=groupId,
+            groupName=ttWrapper.groupName,
+            members=[
+                {"id": x["id"], "identifier": x["identifier"], "hasPin": x["hasPin"]}
+                for x in ttWrapper.groupMembers
+            ],
+            refreshed=datetime.utcnow(),
+        )
+
+        previous = GroupRoster.get_by_id(groupId)
+        roster.put()
+
+        return roster, previous
+
+    # Returns the stored roster of a group, loading it again if it is older than maxAge
+    # Returns None if the group couldn't be loaded
+    # Users of members that changed since the stored roster are repaired afterwards
+    @classmethod
+    def getRoster(cls, groupId: str, maxAge: timedelta = MAX_AGE) -> GroupRoster:
+
+        with cls.groupLocks.hold(groupId):
+            roster = GroupRoster.get_by_id(groupId, use_cache=False)
+            if roster is not None and roster.isFresh(maxAge):
+                return roster
+
+            result = cls.refresh(groupId)
+            if result is None:
+                return None
+
+            roster, previous = result
+
+        # The first roster of a group has nothing to compare against, so all of its
+        # users would be rewritten; that is left to refreshAll
+        if previous is not None:
+            cls.repairPool.spawn(
+                cls.repairInBackground, groupId, roster.changedSince(previous)
+            )
+
+        return roster
+
+    @classmethod
+    @withContext
+    def repairInBackground(cls, groupId: str, changed: dict):
+        try:
+            cls.repairUsers(groupId, changed)
+        except Exception:
+            logger.exception(f"Failed to update users of group {groupId}")
+
+    # Updates the names and PIN status of users whose members changed
+    # Members are matched by ID, so users are kept when their member is renamed
+    # Returns the number of users updated
+    @classmethod
+    def repairUsers(cls, groupId: str, changed: dict) -> int:
+
+        if not changed:
+            return 0
+
+        @ndb.transactional()
+        def repair(keys: list) -> int:
+            users = []
+            for user in ndb.get_multi(keys, use_cache=False):
+                member = changed.get(user.memberId) if user else None
+                if member is None:
+                    continue
+
+                memberName, pin = user.memberName, user.pin
+
+                user.memberName = member["identifier"]
+                # Users yet to confirm their name store whether their member has a PIN
+                if user.pin in ["True", "False"]:
+                    user.pin = str(member["hasPin"])
+
+                if (memberName, pin) != (user.memberName, user.pin):
+                    users.append(user)
+
+            ndb.put_multi(users, use_cache=False)
+            return len(users)
+
+        query = User.query(User.groupId == groupId)
+
+        repaired = 0
+        for keys, _, _ in iterPages(query, cls.PAGE_SIZE, keys_only=True):
+            repaired += repair(keys)
+
+        if repaired:
+            logger.info(f"Updated {repaired} users after group {groupId} changed")
+
+        return repaired
+
+    # Refreshes the roster of every group with users that haven't blocked the bot
+    # Groups are loaded concurrently, limited by TemptakingWrapper.requestQueue
+    @classmethod
+    def refreshAll(cls) -> str:
+
+        start = time()
+
+        # Requires the (blocked, groupId) index in index.yaml
+        query = User.query(
+            User.blocked == False, projection=[User.groupId], distinct=True
+        )
+        groupIds = [x.groupId for x in query.fetch() if x.groupId]
+
+        @withContext
+        def refreshGroup(groupId: str):
+            with cls.groupLocks.hold(groupId):
+                result = cls.refresh(groupId)
+
+            if result is None:
+                return False, 0
+
+            roster, previous = result
+            return True, cls.repairUsers(groupId, roster.changedSince(previous))
+
+        pool = TrackedGroup()
+        respList = pool.imap_unordered(
+            refreshGroup, groupIds, maxsize=TemptakingWrapper.requestQueue.concurrency
+        )
+
+        loaded, failed, repaired = 0, 0, 0
+        for ok, count in respList:
+            loaded += ok
+            failed += not ok
+            repaired += count
+
+        elapsedTime = time() - start
+
+        logStr = f"Refreshed {loaded} groups in {elapsedTime:.4f}s. Failures: {failed}, users updated: {repaired}"
+
+        logger.info(logStr)
+        return logStr
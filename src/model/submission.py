@@ -0,0 +1,67 @@
+#
+#   Cloud NDB entity recording a temperature submitted to temptaking.ado.sg
+#
+
+import csv
+import io
+from datetime import date
+from google.cloud import ndb
+
+from ..util.pagedQuery import iterPages
+
+
+class Submission(ndb.Model):
+
+    chatId = ndb.StringProperty(indexed=False)
+    groupId = ndb.StringProperty()
+    memberName = ndb.StringProperty(indexed=False)
+
+    # Date of the session in local time
+    date = ndb.DateProperty()
+    meridies = ndb.StringProperty(indexed=False)
+    temp = ndb.FloatProperty(indexed=False)
+
+    # Seconds taken by the website to accept the submission
+    latency = ndb.FloatProperty(indexed=False)
+    submitted = ndb.DateTimeProperty(auto_now_add=True, indexed=False)
+
+    CSV_FIELDS = ["date", "meridies", "memberName", "temp", "chatId", "latency"]
+    PAGE_SIZE = 500
+
+    # Requires the (groupId, date) index in index.yaml
+    @classmethod
+    def queryGroup(cls, groupId: str, start: date, end: date) -> ndb.Query:
+        return cls.query(
+            cls.groupId == groupId, cls.date >= start, cls.date <= end
+        ).order(cls.date)
+
+    # Yields the submissions of a group as CSV, one chunk per page
+    @classmethod
+    def iterCsv(cls, groupId: str, start: date, end: date):
+
+        buffer = io.StringIO()
+        writer = csv.writer(buffer)
+        writer.writerow(cls.CSV_FIELDS)
+
+        for results, _, _ in iterPages(
+            cls.queryGroup(groupId, start, end), cls.PAGE_SIZE
+        ):
+            writer.writerows(x.toRow() for x in results)
+            yield buffer.getvalue()
+
+            buffer.seek(0)
+            buffer.truncate()
+
+        # Header only
+        if buffer.tell():
+            yield buffer.getvalue()
+
+    def toRow(self) -> list:
+        return [
+            self.date.isoformat() if self.date else None,
+            self.meridies,
+            self.memberName,
+            self.temp,
+            self.chatId,
+            round(self.latency, 3) if self.latency is not None else None,
+        ]
@@ -48,6 +48,14 @@ class TelegramMarkup:
         "one_time_keyboard": True,
     }
 
+    # Texts of the fixed keyboard buttons, which users send back as replies
+    @classmethod
+    def keyboardTexts(cls) -> set:
+        keyboards = [
+            v for v in vars(cls).values() if isinstance(v, dict) and "keyboard" in v
+        ]
+        return {text for x in keyboards for row in x["keyboard"] for text in row}
+
     @classmethod
     def NameSelectionKeyboard(cls, names: list):
         return {
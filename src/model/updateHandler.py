@@ -5,24 +5,57 @@
 import logging
 import json
 import re
-import requests
+from time import time
+from datetime import datetime
+from collections import Counter
+from google.cloud import ndb
 
 logger = logging.getLogger(__name__)
 
 from ..stringConstants import StringConstants
 
 from .user import User, UserState
+from .userStats import UserStats
+from .submission import Submission
+from .rosterHandler import RosterHandler
 from .webhookUpdate import WebhookUpdate
 from .telegramMarkup import TelegramMarkup
 from ..util.temptakingWrapper import TemptakingWrapper
 from ..util.fmtDateTime import FmtDateTime
+from ..util.keyedLock import KeyedLock
+from ..util.ndbClient import datastoreQueue
+from ..util.temperatureSubmitter import TemperatureSubmitter
 
 STRINGS = StringConstants().STRINGS
 
 
+# Raised when the User entity was written by someone else after it was loaded
+class StaleUserError(Exception):
+    pass
+
+
 class UpdateHandler:
-    def __init__(self, updateObj: WebhookUpdate):
+
+    # Updates from the same chat are handled one at a time within an instance
+    chatLocks = KeyedLock()
+
+    # Number of times an update is handled again after losing a write race
+    MAX_ATTEMPTS = 3
+
+    # Temperature submissions from all chats share a pool of connections
+    submitter = TemperatureSubmitter()
+
+    # A prefetched User entity can be passed in to save a Datastore read
+    def __init__(self, updateObj: WebhookUpdate, user: User = None):
         self.update = updateObj
+        self.user = user
+
+        # Counted fields of the user as last saved, and other pending counter changes
+        self.userSnapshot = None
+        self.statsDeltas = Counter()
+
+        # Results of calls to external services, kept across retries of handle()
+        self.results = {}
 
     def process(self):
 
@@ -32,10 +65,36 @@ class UpdateHandler:
 
             return resp
 
+        with self.chatLocks.hold(self.update.chatId):
+            for _ in range(self.MAX_ATTEMPTS):
+                try:
+                    return self.handle()
+
+                except StaleUserError:
+                    # Another instance wrote this user concurrently, so reload and retry
+                    logger.info(f"Retrying update for stale user {self.update.chatId}")
+                    ndb.get_context().clear_cache()
+                    self.user = None
+
+        return self.update.makeReply(STRINGS["concurrent_update"], reply=False)
+
+    def handle(self):
+
         # Get User entity or create a new User if this is the User's first interaction
         # This is strange because we are not querying against a particular entity key
         # but the legacy database has its own PK field which is the user's Telegram user ID
-        self.user: User = User.get_or_insert(self.update.chatId)
+        # New users are only stored once their state is first saved
+        if self.user is None:
+            with datastoreQueue.slot():
+                self.user: User = User.get_by_id(self.update.chatId)
+
+        if self.user is None:
+            self.user = User(id=self.update.chatId)
+            self.userSnapshot = None
+        else:
+            self.userSnapshot = UserStats.snapshot(self.user)
+
+        self.statsDeltas = Counter()
 
         if self.update.text.startswith("/"):
             # User issued a command (does not depend on user state)
@@ -44,6 +103,46 @@ class UpdateHandler:
             # Pass to state machine
             return self.handleByState()
 
+    # Calls fn only once per update, even if handle() is retried after losing a write
+    # race, so that e.g. a temperature isn't submitted twice
+    # The result is reused and only the state change is applied to the reloaded user
+    def once(self, key, fn, *args):
+        if key not in self.results:
+            self.results[key] = fn(*args)
+
+        return self.results[key]
+
+    # Writes the User entity only if nobody else has written it since it was loaded
+    # Other entities passed in are written in the same transaction
+    def saveUser(self, *entities):
+
+        expectedVersion = self.user.version
+
+        @ndb.transactional()
+        def checkAndPut():
+            stored: User = self.user.key.get(use_cache=False)
+            if stored is not None and stored.version != expectedVersion:
+                raise StaleUserError()
+
+            # Transactions may be retried, and the version is bumped on every put
+            self.user.version = expectedVersion
+            self.user.lastActive = datetime.utcnow()
+            self.user.put()
+            ndb.put_multi(entities)
+
+        snapshot = UserStats.snapshot(self.user)
+        with datastoreQueue.slot():
+            checkAndPut()
+
+        # Statistics are updated once the user is committed, so the shards don't
+        # contend with the user's transaction
+        deltas = UserStats.diff(self.userSnapshot, snapshot)
+        deltas.update(self.statsDeltas)
+        UserStats.applyLater(deltas)
+
+        self.userSnapshot = snapshot
+        self.statsDeltas = Counter()
+
     # Starts the reminder wizard
     def startReminderWizard(self):
 
@@ -62,7 +161,7 @@ class UpdateHandler:
 
         # Now waiting for user to send AM reminder time
         self.user.status = UserState.REMIND_SET_AM
-        self.user.put()
+        self.saveUser()
 
         return self.update.makeReply(text, TelegramMarkup.ReminderAmKeyboard)
 
@@ -75,7 +174,7 @@ class UpdateHandler:
         if command == "/start":
             # Reset user state
             self.user.reset()
-            self.user.put()
+            self.saveUser()
 
             return self.update.makeReply(STRINGS["SAF100"], reply=False)
 
@@ -86,7 +185,7 @@ class UpdateHandler:
 
                 # Override previous temperature for this session
                 self.user.temp = User.TEMP_NONE
-                self.user.put()
+                self.saveUser()
 
                 return self.sendReminder()
 
@@ -143,7 +242,7 @@ class UpdateHandler:
             )
 
             self.user.status = UserState.TEMP_REPORT
-            self.user.put()
+            self.saveUser()
 
             return self.update.makeReply(
                 text, TelegramMarkup.TemperatureKeyboard, reply=False
@@ -171,26 +270,16 @@ class UpdateHandler:
     def submitTemp(self, temp):
 
         now = FmtDateTime.now()
-        try:
-            url = TemptakingWrapper.BASE_URL + "MemberSubmitTemperature"
-            payload = {
-                "groupCode": self.user.groupId,
-                "date": now.date,
-                "meridies": now.meridies,
-                "memberId": self.user.memberId,
-                "temperature": temp,
-                "pin": self.user.pin,
-            }
-
-            resp = requests.post(url, data=payload)
-            logger.debug("Temperature submission returned: {}".format(resp.text))
-
-        except Exception as e:
+        payload = {
+            "groupCode": self.user.groupId,
+            "date": now.date,
+            "meridies": now.meridies,
+            "memberId": self.user.memberId,
+            "temperature": temp,
+            "pin": self.user.pin,
+        }
 
-            logger.error(e)
-            return "error"
-
-        return resp.text
+        return self.once(("submitTemp", temp), self.submitter.submit, payload)
 
     def handleByState(self):
 
@@ -199,11 +288,11 @@ class UpdateHandler:
         # Get temptaking data
         if state == UserState.INIT_START:
 
-            ttWrapper = TemptakingWrapper(self.update.text)
+            ttWrapper = self.once("group", TemptakingWrapper, self.update.text)
             if not ttWrapper.isValid():
                 return self.update.makeReply(STRINGS["invalid_url"])
 
-            if ttWrapper.load():
+            if self.once("loadGroup", ttWrapper.load):
 
                 self.user.groupName = ttWrapper.groupName
                 self.user.groupId = ttWrapper.groupId
@@ -211,7 +300,7 @@ class UpdateHandler:
                 self.user.status = UserState.INIT_CONFIRM_URL
                 self.user.temp = User.TEMP_NONE
                 self.user.blocked = False
-                self.user.put()
+                self.saveUser()
 
                 return self.update.makeReply(
                     STRINGS["group_msg"].format(ttWrapper.groupName),
@@ -227,7 +316,7 @@ class UpdateHandler:
             if self.update.text == STRINGS["group_keyboard_yes"]:
 
                 self.user.status = UserState.INIT_GET_NAME
-                self.user.put()
+                self.saveUser()
 
                 return self.queryMemberName()
 
@@ -236,7 +325,7 @@ class UpdateHandler:
                 # Reset user to previous state to reenter group URL
                 self.user.reset()
                 self.user.status = UserState.INIT_START
-                self.user.put()
+                self.saveUser()
 
                 return self.update.makeReply(STRINGS["SAF100_2"], reply=False)
 
@@ -267,7 +356,7 @@ class UpdateHandler:
             self.user.memberId = groupMembers[idx]["id"]
             self.user.memberName = groupMembers[idx]["identifier"]
             self.user.pin = str(groupMembers[idx]["hasPin"])
-            self.user.put()
+            self.saveUser()
 
             text = STRINGS["member_msg_2"].format(self.user.memberName)
             return self.update.makeReply(
@@ -280,56 +369,49 @@ class UpdateHandler:
             # User has previously confirmed member name and is returning to set PIN
             if self.user.pin == User.PIN_NOTSET:
 
-                groupUrl = TemptakingWrapper.BASE_URL + self.user.groupId
-                ttWrapper = TemptakingWrapper(groupUrl)
-
-                if ttWrapper.load():
-
-                    groupMembers = ttWrapper.groupMembers
-                    try:
-                        idx = [x["identifier"] for x in groupMembers].index(
-                            self.user.memberName
-                        )
-
-                        # User has a configured PIN now
-                        if groupMembers[idx]["hasPin"]:
-                            self.user.status = UserState.INIT_GET_PIN
-                            self.user.pin = None
-                            self.user.put()
-
-                            return self.update.makeReply(
-                                STRINGS["pin_msg_1"], reply=False
-                            )
-
-                        # User is a liar
-                        else:
-                            text = STRINGS["set_pin_2"].format(self.user.groupId)
-                            return self.update.makeReply(
-                                text,
-                                markup=TelegramMarkup.PinConfiguredKeyboard,
-                                reply=False,
-                            )
-
-                    except ValueError:
-                        # User has somehow ceased to exist
-                        # This could be a result of user changing groups or their member names
-                        # and is easier to just start from a blank slate
-                        self.user.reset()
-                        self.user.put()
-
-                        return self.update.makeReply(
-                            STRINGS["fatal_error"], reply=False
-                        )
+                # Users of the same group checking at once share a single load of
+                # the group, and members are found by ID in case they were renamed
+                roster = self.once(
+                    "roster", RosterHandler.getRoster, self.user.groupId
+                )
+                if roster is None:
+                    return self.handleTemptakingError()
+
+                member = roster.member(self.user.memberId)
 
+                if member is None:
+                    # User has somehow ceased to exist
+                    # This could be a result of user changing groups and is easier to
+                    # just start from a blank slate
+                    self.user.reset()
+                    self.saveUser()
+
+                    return self.update.makeReply(STRINGS["fatal_error"], reply=False)
+
+                # User has a configured PIN now
+                elif member["hasPin"]:
+                    self.user.status = UserState.INIT_GET_PIN
+                    self.user.memberName = member["identifier"]
+                    self.user.pin = None
+                    self.saveUser()
+
+                    return self.update.makeReply(STRINGS["pin_msg_1"], reply=False)
+
+                # User is a liar
                 else:
-                    return self.handleTemptakingError()
+                    text = STRINGS["set_pin_2"].format(self.user.groupId)
+                    return self.update.makeReply(
+                        text,
+                        markup=TelegramMarkup.PinConfiguredKeyboard,
+                        reply=False,
+                    )
 
             # Otherwise user has not yet confirmed their name
             if self.update.text == STRINGS["member_keyboard_no"]:
                 # Ask again
                 self.user.status = UserState.INIT_GET_NAME
                 self.user.memberName = None
-                self.user.put()
+                self.saveUser()
 
                 return self.queryMemberName()
 
@@ -339,7 +421,7 @@ class UpdateHandler:
                     # User has already set a PIN on the website
                     self.user.status = UserState.INIT_GET_PIN
                     self.user.groupMembers = None
-                    self.user.put()
+                    self.saveUser()
 
                     return self.update.makeReply(STRINGS["pin_msg_1"], reply=False)
 
@@ -348,7 +430,7 @@ class UpdateHandler:
                     text = STRINGS["set_pin_1"].format(self.user.groupId)
 
                     self.user.pin = User.PIN_NOTSET
-                    self.user.put()
+                    self.saveUser()
 
                     return self.update.makeReply(
                         text, markup=TelegramMarkup.PinConfiguredKeyboard, reply=False
@@ -374,7 +456,7 @@ class UpdateHandler:
 
                 self.user.status = UserState.INIT_CONFIRM_PIN
                 self.user.pin = pin
-                self.user.put()
+                self.saveUser()
 
                 return self.update.makeReply(
                     text, markup=TelegramMarkup.PinConfirmationKeyboard, reply=False
@@ -394,7 +476,7 @@ class UpdateHandler:
                 )
 
                 self.user.status = UserState.INIT_SUMMARY
-                self.user.put()
+                self.saveUser()
 
                 # TODO notify admins
 
@@ -406,7 +488,7 @@ class UpdateHandler:
                 # Ask for PIN again
                 self.user.status = UserState.INIT_GET_PIN
                 self.user.pin = None
-                self.user.put()
+                self.saveUser()
 
                 return self.update.makeReply(STRINGS["pin_msg_1"], reply=False)
 
@@ -424,7 +506,7 @@ class UpdateHandler:
 
                 # Reset state right to the beginning
                 self.user.reset()
-                self.user.put()
+                self.saveUser()
 
                 return self.update.makeReply(STRINGS["SAF100"], reply=False)
 
@@ -451,7 +533,7 @@ class UpdateHandler:
             else:
                 self.user.remindAM = int(self.update.text[:2])
                 self.user.status = UserState.REMIND_SET_PM
-                self.user.put()
+                self.saveUser()
 
                 text = STRINGS["reminder_change_config"].format("PM")
                 return self.update.makeReply(
@@ -471,7 +553,7 @@ class UpdateHandler:
             else:
                 self.user.remindPM = int(self.update.text[:2])
                 self.user.status = UserState.TEMP_DEFAULT
-                self.user.put()
+                self.saveUser()
 
                 text = STRINGS["reminder_successful_change"].format(
                     f"{self.user.remindAM:02}:01", f"{self.user.remindPM:02}:01"
@@ -514,10 +596,20 @@ class UpdateHandler:
 
             else:
 
+                submitStart = time()
                 resp = self.submitTemp(temp)
                 if resp == "OK":
 
                     now = FmtDateTime.now()
+                    submission = Submission(
+                        chatId=self.update.chatId,
+                        groupId=self.user.groupId,
+                        memberName=self.user.memberName,
+                        date=now.dateObj.date(),
+                        meridies=now.meridies,
+                        temp=temp,
+                        latency=time() - submitStart,
+                    )
                     text = STRINGS["just_submitted"].format(
                         now.dayOfWeek,
                         now.shortDate,
@@ -529,7 +621,8 @@ class UpdateHandler:
 
                     self.user.status = UserState.TEMP_DEFAULT
                     self.user.temp = str(temp)
-                    self.user.put()
+                    self.statsDeltas[UserStats.submittedCounter(now)] += 1
+                    self.saveUser(submission)
 
                     return self.update.makeReply(text, reply=False)
 
@@ -537,7 +630,7 @@ class UpdateHandler:
 
                     self.user.status = UserState.WRONG_PIN
                     self.user.temp = User.TEMP_ERROR
-                    self.user.put()
+                    self.saveUser()
 
                     return self.update.makeReply(STRINGS["wrong_pin"], reply=False)
 
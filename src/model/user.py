@@ -2,6 +2,8 @@
 #   Cloud NDB entity for handling user
 #
 
+import os
+import zlib
 from google.cloud import ndb
 
 # The string enum values are inherited for back-compatability reasons
@@ -30,11 +32,8 @@ class UserState:
     RESUBMIT_TEMP = "resubmit temp"
 
 
-# Some fields are unused but their logic is maintained for back-compatability
+# Legacy entities are normalised by src/migrate.py
 class User(ndb.Model):
-    # Currently unused
-    firstName = ndb.StringProperty()
-
     # User state in the state machine
     status = ndb.StringProperty(default=UserState.INIT_DEFAULT)
 
@@ -64,13 +63,32 @@ class User(ndb.Model):
     VALID_AM_TIMES = [f"{x:02}:01" for x in range(12)]
     VALID_PM_TIMES = [f"{x:02}:01" for x in range(12, 24)]
 
+    # Reminders are spread over this many minutes after HH:01 to flatten the load
+    # Each user is deterministically assigned a minute within the window from their
+    # chat ID, so nothing has to be stored and the window can be changed at any time
+    REMIND_WINDOW = int(os.environ.get("REMIND_WINDOW", 1))
+
     blocked = ndb.BooleanProperty(default=False)
 
+    # Last time the user's state was changed by one of their messages
+    lastActive = ndb.DateTimeProperty()
+
+    # Incremented on every write for optimistic concurrency control
+    version = ndb.IntegerProperty(default=0, indexed=False)
+
+    # Minutes after HH:01 at which the user's reminders are sent
+    @classmethod
+    def remindOffsetFor(cls, chatId) -> int:
+        return zlib.crc32(str(chatId).encode()) % cls.REMIND_WINDOW
+
     # To maintain back-compatability with the Cloud Datastore
     @classmethod
     def _get_kind(cls):
         return "Client"
 
+    def _pre_put_hook(self):
+        self.version = (self.version or 0) + 1
+
     def reset(self):
         self.status = UserState.INIT_START
         self.groupId = None
@@ -79,7 +97,7 @@ class User(ndb.Model):
         self.memberName = None
         self.memberId = None
         self.pin = None
-        self.temp = "init"
+        self.temp = None
         self.remindAM = -1
         self.remindPM = -1
         self.blocked = False
@@ -91,6 +109,7 @@ class User(ndb.Model):
             UserState.TEMP_REPORT,
             UserState.REMIND_SET_AM,
             UserState.REMIND_SET_PM,
+            # Legacy statuses, normalised by src/migrate.py
             "offline,endgame 1",
             "offline,endgame 2",
             "offline,remind wizard 1",
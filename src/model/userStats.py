@@ -0,0 +1,158 @@
+#
+#   Sharded counters for live statistics of User entities
+#   Counters are updated incrementally whenever a user's state changes, so reading
+#   them costs a single get_multi instead of a query over all users
+#
+
+import random
+import logging
+from collections import Counter
+from google.cloud import ndb
+
+from .user import User, UserState
+from ..util.fmtDateTime import FmtDateTime
+
+logger = logging.getLogger(__name__)
+
+
+# One shard of a counter; the entity ID is "<counter name>/<shard index>"
+# The shard with the ID RECOUNTED holds the number of users at the last recount
+class UserStatsShard(ndb.Model):
+    count = ndb.IntegerProperty(default=0, indexed=False)
+
+
+class StatsNotCountedError(Exception):
+    pass
+
+
+class UserStats:
+
+    # More shards allow more concurrent increments of the same counter
+    SHARDS = 20
+
+    # Names of counters
+    BLOCKED = "blocked"
+
+    # Counters only hold changes until they are seeded by a recount (see migrate.py)
+    RECOUNTED = "recounted"
+
+    @classmethod
+    def stateCounter(cls, status: str) -> str:
+        return f"state:{status}"
+
+    # Number of users that have submitted during a session (e.g. "01/01/2021 AM")
+    @classmethod
+    def submittedCounter(cls, now: FmtDateTime = None) -> str:
+        now = now or FmtDateTime.now()
+        return f"submitted:{now.date} {now.meridies}"
+
+    # Fields of a user that are counted
+    @classmethod
+    def snapshot(cls, user: User) -> tuple:
+        return (user.status, bool(user.blocked))
+
+    # Counter changes for a user going from one snapshot to another
+    @classmethod
+    def diff(cls, before: tuple, after: tuple) -> Counter:
+        deltas = Counter()
+
+        # New users have no previous snapshot
+        if before is not None:
+            deltas[cls.stateCounter(before[0])] -= 1
+            deltas[cls.BLOCKED] -= int(before[1])
+
+        deltas[cls.stateCounter(after[0])] += 1
+        deltas[cls.BLOCKED] += int(after[1])
+
+        return Counter({k: v for k, v in deltas.items() if v != 0})
+
+    # Applies changes to the counters; all changes go to the same random shard
+    # Can be called within an existing transaction
+    @classmethod
+    def apply(cls, deltas: dict):
+
+        deltas = {k: v for k, v in deltas.items() if v != 0}
+        if not deltas:
+            return
+
+        shard = random.randrange(cls.SHARDS)
+
+        @ndb.transactional(join=True)
+        def increment():
+            keys = [ndb.Key(UserStatsShard, f"{x}/{shard}") for x in deltas]
+            shards = ndb.get_multi(keys)
+
+            for i, delta in enumerate(deltas.values()):
+                if shards[i] is None:
+                    shards[i] = UserStatsShard(key=keys[i])
+                shards[i].count += delta
+
+            ndb.put_multi(shards)
+
+        increment()
+
+    # Applies changes outside of the transaction that made them, so that users aren't
+    # written together with a shard, and a failure only loses the changes
+    @classmethod
+    def applyLater(cls, deltas: dict):
+        try:
+            cls.apply(deltas)
+        except Exception as e:
+            logger.warning(f"Failed to update user stats: {e}")
+
+    # Overwrites counters with totals counted from the User entities
+    @classmethod
+    def reset(cls, totals: dict):
+
+        names = set(totals) | {
+            x for x in cls.counterNames() if x != cls.submittedCounter()
+        }
+        shards = [
+            UserStatsShard(
+                id=f"{name}/{shard}", count=totals.get(name, 0) if shard == 0 else 0
+            )
+            for name in names
+            for shard in range(cls.SHARDS)
+        ]
+        users = sum(v for k, v in totals.items() if k.startswith(cls.stateCounter("")))
+        shards.append(UserStatsShard(id=cls.RECOUNTED, count=users))
+
+        ndb.put_multi(shards)
+
+    # Names of all counters that are reported
+    @classmethod
+    def counterNames(cls) -> list:
+        states = [
+            v
+            for k, v in vars(UserState).items()
+            if not k.startswith("_") and isinstance(v, str)
+        ]
+        return [cls.stateCounter(x) for x in states] + [
+            cls.BLOCKED,
+            cls.submittedCounter(),
+        ]
+
+    # Reads all counters with a single get_multi
+    # Raises StatsNotCountedError if the counters haven't been seeded by a recount
+    @classmethod
+    def read(cls) -> dict:
+
+        names = cls.counterNames()
+        keys = [
+            ndb.Key(UserStatsShard, f"{name}/{shard}")
+            for name in names
+            for shard in range(cls.SHARDS)
+        ]
+
+        recounted, *entities = ndb.get_multi(
+            [ndb.Key(UserStatsShard, cls.RECOUNTED)] + keys
+        )
+        if recounted is None:
+            raise StatsNotCountedError()
+
+        totals = dict.fromkeys(names, 0)
+        for key, entity in zip(keys, entities):
+            if entity is not None:
+                totals[key.id().rsplit("/", 1)[0]] += entity.count
+
+        return totals
@@ -6,6 +6,11 @@ from .telegramMarkup import TelegramMarkup
 
 
 class WebhookUpdate:
+
+    # Update types the bot subscribes to when configuring its webhook
+    # Telegram will not deliver other types (channel posts, callback queries, etc.)
+    ALLOWED_UPDATES = ["message", "edited_message"]
+
     def __init__(self, updateId, messageObj):
         # Not explicitly used but could be useful
         self.id = updateId
@@ -16,13 +21,31 @@ class WebhookUpdate:
             self.messageId: str = str(messageObj["message_id"])
             self.fromUserId: str = messageObj["from"]
             self.chatId: str = str(messageObj["chat"]["id"])
+            # Missing for spoofed updates so these are treated as private chats
+            self.chatType: str = messageObj["chat"].get("type", "private")
         except:
             # Some field is empty
             self._isValid = False
 
+    # Extracts the message component of a raw update
+    # Returns None if the update has no message component
+    @classmethod
+    def fromBody(cls, body: dict) -> "WebhookUpdate":
+        for updateType in cls.ALLOWED_UPDATES:
+            if updateType in body:
+                return WebhookUpdate(
+                    updateId=body.get("update_id"), messageObj=body[updateType]
+                )
+
+        return None
+
     def isValid(self):
         return self._isValid
 
+    # The bot only converses in private chats; group chatter is ignored
+    def isPrivate(self):
+        return self.chatType == "private"
+
     # Creates a payload for responding to this update
     # By default, the message will be a reply to this update
     def makeReply(self, text: str, markup: TelegramMarkup = None, reply=True):
@@ -0,0 +1,161 @@
+#
+#   Long-polling runner for self-hosted deployments
+#   Receives updates through getUpdates instead of the webhook
+#
+#   Usage: python -m src.poller [--batch-size 100] [--concurrency 50]
+#
+
+from gevent import monkey
+
+monkey.patch_all()
+
+import logging
+import argparse
+from collections import OrderedDict
+from time import time
+import gevent
+from google.cloud import ndb
+
+from .app import loadSecrets
+from .model.user import User
+from .model.webhookUpdate import WebhookUpdate
+from .model.updateHandler import UpdateHandler
+from .model.replyOutbox import ReplyOutbox
+from .util.ndbClient import getNdbClient, withContext
+from .util.telegramWrapper import TelegramApiWrapper
+from .util.trackedGroup import TrackedGroup
+
+logger = logging.getLogger(__name__)
+
+
+class UpdatePoller:
+    def __init__(
+        self,
+        telegramApi: TelegramApiWrapper,
+        batchSize: int = 100,
+        concurrency: int = 50,
+        pollTimeout: int = 30,
+    ):
+        self.telegramApi = telegramApi
+        self.outbox = ReplyOutbox(telegramApi)
+        # Telegram returns at most 100 updates per call
+        self.batchSize = min(batchSize, 100)
+        self.concurrency = concurrency
+        self.pollTimeout = pollTimeout
+
+        # ID of the next update to be fetched
+        self.offset = None
+
+    # Handles all updates from a single chat in the order they were received
+    # A failed update is logged and skipped, since the batch is acknowledged as a
+    # whole and handling it again would repeat the updates that succeeded
+    @withContext
+    def processChat(self, chat: tuple):
+
+        updates, user = chat
+
+        for updateObj in updates:
+            updateHandler = UpdateHandler(updateObj, user)
+            try:
+                resp = updateHandler.process()
+            except Exception:
+                logger.exception(f"Failed to handle update from {updateObj.chatId}")
+                # The user's state is unknown, so the next update reloads it
+                user = None
+                continue
+
+            self.outbox.send(resp)
+
+            # Later updates continue from the state left by this one, unless the
+            # user hasn't been stored yet
+            user = updateHandler.user if updateHandler.userSnapshot else None
+
+    # Processes one batch of updates; chats are handled concurrently
+    def processBatch(self, updates: list):
+
+        # Group updates by chat while preserving their order
+        chats = OrderedDict()
+        for body in updates:
+            updateObj = WebhookUpdate.fromBody(body)
+
+            if updateObj is None or not updateObj.isValid():
+                continue
+            if not updateObj.isPrivate():
+                continue
+
+            chats.setdefault(updateObj.chatId, []).append(updateObj)
+
+        if not chats:
+            return
+
+        # Fetch all users in the batch with a single Datastore call
+        users = ndb.get_multi([ndb.Key(User, x) for x in chats.keys()])
+
+        pool = TrackedGroup()
+        for _ in pool.imap_unordered(
+            self.processChat, zip(chats.values(), users), maxsize=self.concurrency
+        ):
+            pass
+
+    def run(self):
+
+        # getUpdates can't be used while a webhook is configured
+        self.telegramApi.clearWebhook()
+        logger.info("Started polling for updates")
+        self.outbox.ensureDrainer()
+
+        with getNdbClient().context():
+            while True:
+                try:
+                    resp = self.telegramApi.getUpdates(
+                        self.offset,
+                        self.batchSize,
+                        self.pollTimeout,
+                        WebhookUpdate.ALLOWED_UPDATES,
+                    )
+                except Exception as e:
+                    logger.error(e)
+                    gevent.sleep(1)
+                    continue
+
+                if not resp["ok"]:
+                    logger.error(resp["description"])
+                    gevent.sleep(1)
+                    continue
+
+                updates = resp["result"]
+                if not updates:
+                    continue
+
+                start = time()
+                try:
+                    self.processBatch(updates)
+                except Exception:
+                    logger.exception(f"Failed to process {len(updates)} updates")
+                finally:
+                    # Acknowledge the batch on the next call, even if it failed, so
+                    # that it isn't handled again after a restart
+                    self.offset = updates[-1]["update_id"] + 1
+
+                elapsedTime = time() - start
+                logger.info(
+                    f"Processed {len(updates)} updates in {elapsedTime:.4f}s ({len(updates) / elapsedTime:.2f}/s)"
+                )
+
+
+if __name__ == "__main__":
+
+    parser = argparse.ArgumentParser(description="Receive updates by long polling")
+    parser.add_argument("--batch-size", type=int, default=100)
+    parser.add_argument("--concurrency", type=int, default=50)
+    parser.add_argument("--poll-timeout", type=int, default=30)
+    args = parser.parse_args()
+
+    SECRETS = loadSecrets()
+    poller = UpdatePoller(
+        TelegramApiWrapper(SECRETS["telegram-bot"]),
+        batchSize=args.batch_size,
+        concurrency=args.concurrency,
+        pollTimeout=args.poll_timeout,
+    )
+    poller.run()
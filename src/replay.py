@@ -0,0 +1,108 @@
+#
+#   Replays recorded updates (see util/updateRecorder.py) against the application
+#   to capacity plan for traffic spikes
+#
+#   The application is run in-process, so point it at local stand-ins first:
+#     DATASTORE_EMULATOR_HOST     Datastore emulator
+#     TELEGRAM_API_URL            python -m src.tests.fakeTelegram
+#     TEMPTAKING_BASE_URL         python -m src.tests.fakeTemptaking
+#
+#   Usage: python -m src.replay updates.jsonl [--speed 10] [--concurrency 100]
+#
+
+from gevent import monkey
+
+monkey.patch_all()
+
+import json
+import logging
+import argparse
+import gevent
+from time import time
+from collections import Counter
+from gevent.pool import Pool
+
+from .app import create_app, loadSecrets
+from .util.stats import summarise
+
+logger = logging.getLogger(__name__)
+
+
+def loadRecording(path: str) -> list:
+    with open(path, encoding="utf-8") as ff:
+        records = [json.loads(line) for line in ff if line.strip()]
+
+    return sorted(records, key=lambda x: x["time"])
+
+
+# Sends each update to the webhook at its recorded time divided by the speedup
+# Returns a report of throughput, latencies and errors
+def replay(records: list, speed: float = 1, concurrency: int = 100) -> dict:
+
+    app = create_app()
+    client = app.test_client()
+    webhookUrl = f"/{loadSecrets()['telegram-bot']}/webhook"
+
+    latencies = []
+    statuses = Counter()
+
+    def send(updateId, update):
+        update["update_id"] = updateId
+
+        sendStart = time()
+        try:
+            resp = client.post(webhookUrl, json=update)
+            statuses[resp.status_code] += 1
+        except Exception as e:
+            logger.error(e)
+            statuses["exception"] += 1
+
+        latencies.append(time() - sendStart)
+
+    pool = Pool(concurrency)
+    firstTime = records[0]["time"] if records else 0
+
+    # Update IDs are offset so repeated replays aren't dropped as duplicates, while
+    # redeliveries in the recording keep sharing an ID and are still deduplicated
+    firstId = min((x["update"].get("update_id", 0) for x in records), default=0)
+    baseId = int(time() * 1000)
+
+    start = time()
+    for record in records:
+
+        # Wait until the update is due
+        delay = (record["time"] - firstTime) / speed - (time() - start)
+        if delay > 0:
+            gevent.sleep(delay)
+
+        # Updates that can't be started because the pool is full are delayed, which
+        # shows up in the throughput
+        updateId = baseId + record["update"].get("update_id", 0) - firstId
+        pool.spawn(send, updateId, record["update"])
+
+    pool.join()
+    elapsedTime = time() - start
+
+    errors = sum(v for k, v in statuses.items() if k != 200)
+
+    return {
+        "updates": len(records),
+        "elapsedTime": round(elapsedTime, 4),
+        "recordedTime": round((records[-1]["time"] - firstTime) if records else 0, 4),
+        "throughput": round(len(records) / elapsedTime, 2) if elapsedTime else 0,
+        "latency": summarise(latencies),
+        "errorRate": round(errors / len(records), 4) if records else 0,
+        "statuses": {str(k): v for k, v in statuses.items()},
+    }
+
+
+if __name__ == "__main__":
+
+    parser = argparse.ArgumentParser(description="Replay recorded updates")
+    parser.add_argument("recording", help="JSONL file of recorded updates")
+    parser.add_argument("--speed", type=float, default=1, help="Speedup factor")
+    parser.add_argument("--concurrency", type=int, default=100)
+    args = parser.parse_args()
+
+    report = replay(loadRecording(args.recording), args.speed, args.concurrency)
+    print(json.dumps(report, indent=2))
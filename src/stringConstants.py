@@ -1,12 +1,15 @@
 import json
 
-# TODO These are loading on every instantiation, maybe make this a singleton?
+
+# The string table is loaded once and shared by all instances
 class StringConstants:
 
     STRINGS = None
 
     def __init__(self):
 
-        if not self.STRINGS:
+        if not StringConstants.STRINGS:
             with open("strings.json", encoding="utf-8") as ff:
-                self.STRINGS = json.load(ff)
+                StringConstants.STRINGS = json.load(ff)
+
+        self.STRINGS = StringConstants.STRINGS
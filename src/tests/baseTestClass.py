@@ -37,9 +37,10 @@ class BaseTestClass:
 
     # Spoofs Telegram Bot API update object shape
     # Backend actually uses the chat ID to identify users instead of the actual user ID
+    # Update IDs are unique as duplicate updates are ignored
     def createUpdate(self, text, userId="TEST_CHATID"):
         return {
-            "update_id": "TEST_UPDATEID",
+            "update_id": random.randint(0, 1e10),
             "message": {
                 "message_id": "TEST_MSGID",
                 "date": "TEST_DATE",
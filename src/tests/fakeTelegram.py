@@ -0,0 +1,91 @@
+#
+#   Local stand-in for the Telegram Bot API for offline tests and load runs
+#
+#   Usage: python -m src.tests.fakeTelegram [--port 5002] [--latency 0.05]
+#          [--failure-rate 0.01] [--rate-limit-rate 0.01]
+#   Then run the server under test with TELEGRAM_API_URL=http://localhost:5002
+#
+
+import time
+import random
+import argparse
+from flask import Flask, request, jsonify
+
+
+def createFakeTelegram(
+    latency: float = 0, failureRate: float = 0, rateLimitRate: float = 0
+):
+
+    app = Flask(__name__)
+
+    # Number of messages sent to each chat
+    app.sent = {}
+
+    @app.route("/bot<token>/<method>", methods=["GET", "POST"])
+    def methodRoute(token, method):
+
+        if latency:
+            time.sleep(random.uniform(0.5, 1.5) * latency)
+
+        if random.random() < rateLimitRate:
+            return jsonify(
+                {
+                    "ok": False,
+                    "error_code": 429,
+                    "description": "Too Many Requests: retry after 1",
+                    "parameters": {"retry_after": 1},
+                }
+            )
+
+        if random.random() < failureRate:
+            return jsonify(
+                {"ok": False, "error_code": 400, "description": "Bad Request"}
+            )
+
+        body = request.get_json(silent=True) or {}
+
+        if method == "sendMessage":
+            chatId = str(body.get("chat_id"))
+            app.sent[chatId] = app.sent.get(chatId, 0) + 1
+
+            return jsonify(
+                {
+                    "ok": True,
+                    "result": {
+                        "message_id": app.sent[chatId],
+                        "chat": {"id": chatId, "type": "private"},
+                        "text": body.get("text"),
+                    },
+                }
+            )
+
+        elif method == "getMe":
+            return jsonify(
+                {"ok": True, "result": {"id": 1, "is_bot": True, "username": "fake"}}
+            )
+
+        elif method == "getUpdates":
+            return jsonify({"ok": True, "result": []})
+
+        return jsonify({"ok": True, "result": True})
+
+    return app
+
+
+if __name__ == "__main__":
+
+    parser = argparse.ArgumentParser(description="Local stand-in for the Bot API")
+    parser.add_argument("--port", type=int, default=5002)
+    parser.add_argument("--latency", type=float, default=0)
+    parser.add_argument("--failure-rate", type=float, default=0)
+    parser.add_argument("--rate-limit-rate", type=float, default=0)
+    args = parser.parse_args()
+
+    from gevent import monkey
+
+    monkey.patch_all()
+
+    from gevent.pywsgi import WSGIServer
+
+    app = createFakeTelegram(args.latency, args.failure_rate, args.rate_limit_rate)
+    WSGIServer(("127.0.0.1", args.port), app).serve_forever()
@@ -0,0 +1,129 @@
+#
+#   Local stand-in for temptaking.ado.sg for offline tests and load runs
+#
+#   Usage: python -m src.tests.fakeTemptaking [--port 5001] [--members 300]
+#          [--latency 0.2] [--failure-rate 0.01]
+#   Then run the server under test with TEMPTAKING_BASE_URL=http://localhost:5001/group/
+#
+
+import json
+import time
+import random
+import argparse
+from flask import Flask, request
+
+from .test_temptakingWrapper import (
+    TEST_GROUPID,
+    TEST_GROUPNAME,
+    TEST_MEMBER_NOPIN,
+    TEST_MEMBER_PINSET,
+)
+
+# PIN accepted for every member that has set one
+TEST_PIN = "0000"
+
+
+def makeRoster(size: int) -> list:
+    # Every fifth member hasn't set a PIN
+    return [
+        {
+            "id": str(10000000 + i),
+            "identifier": f"TEST_MEMBER_{i}",
+            "hasPin": i % 5 != 0,
+        }
+        for i in range(size)
+    ]
+
+
+# Creates the fake website
+# groups maps group codes to (group name, members) and defaults to the test group used
+# by the test suite and a group of the given roster size
+def createFakeTemptaking(
+    groups: dict = None,
+    members: int = 300,
+    latency: float = 0,
+    failureRate: float = 0,
+):
+
+    app = Flask(__name__)
+
+    if groups is None:
+        groups = {
+            TEST_GROUPID: (TEST_GROUPNAME, [TEST_MEMBER_NOPIN, TEST_MEMBER_PINSET]),
+            "loadtest": ("thermobot-loadtest", makeRoster(members)),
+        }
+
+    # Simulates a slow or flaky website
+    def simulateConditions():
+        if latency:
+            time.sleep(random.uniform(0.5, 1.5) * latency)
+
+        if random.random() < failureRate:
+            return "Internal Server Error", 500
+
+    @app.route("/group/<groupCode>")
+    def groupRoute(groupCode):
+
+        failure = simulateConditions()
+        if failure:
+            return failure
+
+        if groupCode not in groups:
+            return "<html><body>Invalid code</body></html>"
+
+        groupName, groupMembers = groups[groupCode]
+        groupData = {
+            "groupName": groupName,
+            "groupCode": groupCode,
+            "members": groupMembers,
+        }
+
+        # Mirrors the script tag that TemptakingWrapper scrapes
+        return f"<html><script>loadContents('{json.dumps(groupData)}')</script></html>"
+
+    @app.route("/group/MemberSubmitTemperature", methods=["POST"])
+    def submitRoute():
+
+        failure = simulateConditions()
+        if failure:
+            return failure
+
+        form = request.form
+        if form.get("groupCode") not in groups:
+            return "Invalid code"
+
+        _, groupMembers = groups[form["groupCode"]]
+        members = [x for x in groupMembers if x["id"] == form.get("memberId")]
+        member = members[0] if members else None
+
+        if member is None or not member["hasPin"] or form.get("pin") != TEST_PIN:
+            return "Wrong pin."
+
+        temp = float(form.get("temperature", 0))
+        if temp < 35 or temp > 40:
+            return "Invalid temperature"
+
+        return "OK"
+
+    return app
+
+
+if __name__ == "__main__":
+
+    parser = argparse.ArgumentParser(description="Local stand-in for temptaking.ado.sg")
+    parser.add_argument("--port", type=int, default=5001)
+    parser.add_argument("--members", type=int, default=300)
+    parser.add_argument("--latency", type=float, default=0)
+    parser.add_argument("--failure-rate", type=float, default=0)
+    args = parser.parse_args()
+
+    from gevent import monkey
+
+    monkey.patch_all()
+
+    from gevent.pywsgi import WSGIServer
+
+    app = createFakeTemptaking(
+        members=args.members, latency=args.latency, failureRate=args.failure_rate
+    )
+    WSGIServer(("127.0.0.1", args.port), app).serve_forever()
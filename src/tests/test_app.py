@@ -1,10 +1,16 @@
 import json
+import requests
 
 from google.cloud import ndb
 
 from ..stringConstants import StringConstants
 from ..model.user import User, UserState
 from ..model.telegramMarkup import TelegramMarkup
+from ..model.webhookUpdate import WebhookUpdate
+from ..model.updateHandler import UpdateHandler
+from ..model.groupRoster import GroupRoster
+from ..model.rosterHandler import RosterHandler
+from ..model.userStats import UserStats, UserStatsShard
 
 from .baseTestClass import BaseTestClass
 from .test_temptakingWrapper import *
@@ -47,6 +53,16 @@ class TestApp(BaseTestClass):
         resp = self.sendToWebhook(update)
         assert resp.text == "Invalid update object"
 
+    # Tests that redelivered updates are only processed once
+    def test_duplicateUpdate(self):
+        update = self.createUpdate("/invalid")
+
+        resp = self.sendToWebhook(update)
+        assert resp.json()["text"] == STRINGS["invalid_input"]
+
+        resp = self.sendToWebhook(update)
+        assert resp.text == "Received duplicate update"
+
     # Tests response to non-text messages (update with no text component)
     def test_nonTextMessage(self):
         update = self.createUpdate("")
@@ -55,6 +71,23 @@ class TestApp(BaseTestClass):
         resp = self.sendToWebhook(update)
         assert resp.json()["text"] == STRINGS["no_text_error"]
 
+    # Tests that user stats are reported for every state once they have been counted
+    def test_stats(self):
+        with self.ndbClient.context():
+            recounted = UserStatsShard.get_by_id(UserStats.RECOUNTED)
+
+        resp = requests.get(f"{self.apiUrl}/stats")
+
+        if recounted is None:
+            assert resp.status_code == 503
+            return
+
+        assert resp.status_code == 200
+        stats = resp.json()
+        assert "blocked" in stats
+        assert f"state:{UserState.INIT_START}" in stats
+        assert f"state:{UserState.TEMP_REPORT}" in stats
+
 
 class TestUpdateHandler(BaseTestClass):
 
@@ -457,6 +490,39 @@ class TestInitConfirmName_PinNotSet(BaseTestClass):
             assert resp.json()["reply_markup"] == TelegramMarkup.PinConfiguredKeyboard
             assert user.status == UserState.INIT_CONFIRM_NAME
 
+    # Member was renamed on the website after the user confirmed their name
+    def test_renamedMember(self, mocker):
+        with self.ndbClient.context():
+            userKey = self._createUser(TEST_MEMBER_NOPIN)
+            update = self.createUpdate(STRINGS["pin_keyboard"], userKey.id())
+
+            member = dict(TEST_MEMBER_NOPIN, identifier="thermobot-renamed", hasPin=True)
+            roster = GroupRoster(id=TEST_GROUPID, members=[member])
+            mocker.patch.object(RosterHandler, "getRoster", return_value=roster)
+
+            resp = UpdateHandler(WebhookUpdate.fromBody(update)).process()
+            user: User = userKey.get(use_cache=False)
+
+            assert resp["text"] == STRINGS["pin_msg_1"]
+            assert user.status == UserState.INIT_GET_PIN
+            assert user.memberName == "thermobot-renamed"
+
+    # Member has left the group since the user confirmed their name
+    def test_leftMember(self, mocker):
+        with self.ndbClient.context():
+            userKey = self._createUser(TEST_MEMBER_NOPIN)
+            update = self.createUpdate(STRINGS["pin_keyboard"], userKey.id())
+
+            roster = GroupRoster(id=TEST_GROUPID, members=[TEST_MEMBER_PINSET])
+            mocker.patch.object(RosterHandler, "getRoster", return_value=roster)
+
+            resp = UpdateHandler(WebhookUpdate.fromBody(update)).process()
+            user: User = userKey.get(use_cache=False)
+
+            assert resp["text"] == STRINGS["fatal_error"]
+            assert user.status == UserState.INIT_START
+            assert user.memberId is None
+
 
 # Test handling of INIT_GET_PIN
 class TestInitGetPin(BaseTestClass):
@@ -744,6 +810,46 @@ class TestTempReport(BaseTestClass):
             assert user.status == UserState.TEMP_DEFAULT
             assert user.temp == "36.0"
 
+    # Tests that a temperature is only submitted once when the user is written by
+    # someone else (e.g. a reminder) after the submission
+    def test_submitOnceAfterConflict(self, mocker):
+        with self.ndbClient.context():
+            userKey = self._createUser()
+            update = WebhookUpdate.fromBody(self.createUpdate("36.0", userKey.id()))
+
+            def submitAndConflict(payload):
+                # Another writer bumps the version before the handler saves
+                userKey.get(use_cache=False).put(use_cache=False)
+                return "OK"
+
+            submit = mocker.patch.object(
+                UpdateHandler.submitter, "submit", side_effect=submitAndConflict
+            )
+
+            resp = UpdateHandler(update).process()
+            user: User = userKey.get(use_cache=False)
+
+            assert submit.call_count == 1
+            assert looseCompare(resp["text"], STRINGS["just_submitted"])
+            assert user.status == UserState.TEMP_DEFAULT
+            assert user.temp == "36.0"
+
+    # Tests that submissions are recorded and exported
+    def test_exportSubmissions(self):
+        with self.ndbClient.context():
+            userKey = self._createUser()
+            update = self.createUpdate("36.0", userKey.id())
+            self.sendToWebhook(update)
+
+        resp = requests.get(
+            f"{self.apiUrl}/export/submissions", params={"groupId": TEST_GROUPID}
+        )
+        rows = resp.text.splitlines()
+
+        assert resp.status_code == 200
+        assert rows[0].startswith("date,meridies,memberName,temp")
+        assert any(TEST_MEMBER_PINSET["identifier"] in x for x in rows[1:])
+
     # Tests temperature out of accepted range
     def test_outOfRangeTemp(self):
         with self.ndbClient.context() as context:
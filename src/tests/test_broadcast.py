@@ -1,4 +1,6 @@
+import time
 import random
+import requests
 
 from .baseTestClass import BaseTestClass
 
@@ -19,3 +21,56 @@ class TestBroadcast(BaseTestClass):
 
             resp = self.sendToBase("broadcast", {"msg": "Test broadcast"})
 
+    # Tests that the broadcast job can be queried and cancelled
+    def test_jobStatus(self):
+        resp = self.sendToBase("broadcast", {"msg": "Test broadcast"})
+        jobId = resp.json()["id"]
+
+        resp = requests.get(f"{self.apiUrl}/broadcast/{jobId}")
+        assert resp.status_code == 200
+        assert resp.json()["id"] == jobId
+
+        resp = self.sendToBase(f"broadcast/{jobId}/cancel", {})
+        assert resp.json()["status"] in ["cancelled", "done"]
+
+    # Tests that filtered broadcasts only reach matching users
+    def test_filteredBroadcast(self):
+        with self.ndbClient.context():
+            groupId = f"TEST_GROUP_{random.randint(0, 1e10)}"
+            self.createUser({"groupId": groupId})
+
+        resp = self.sendToBase(
+            "broadcast", {"msg": "Test broadcast", "filters": {"groupId": groupId}}
+        )
+        jobId = resp.json()["id"]
+
+        for _ in range(10):
+            job = requests.get(f"{self.apiUrl}/broadcast/{jobId}").json()
+            if job["status"] == "done":
+                break
+            time.sleep(1)
+
+        assert job["status"] == "done"
+        assert job["sent"] + job["failed"] + job["blocked"] == 1
+
+    # Tests that reminder filters can be combined with activeWithinDays (see index.yaml)
+    def test_activeReminderBroadcast(self):
+        filters = {"remindAM": 7, "activeWithinDays": 1}
+        resp = self.sendToBase("broadcast", {"msg": "Test broadcast", "filters": filters})
+        jobId = resp.json()["id"]
+
+        for _ in range(10):
+            job = requests.get(f"{self.apiUrl}/broadcast/{jobId}").json()
+            if job["status"] != "running":
+                break
+            time.sleep(1)
+
+        assert job["status"] == "done"
+
+    # Tests rejection of unknown filters
+    def test_invalidFilter(self):
+        resp = requests.post(
+            f"{self.apiUrl}/broadcast",
+            json={"msg": "Test broadcast", "filters": {"firstName": "TEST"}},
+        )
+        assert resp.status_code == 400
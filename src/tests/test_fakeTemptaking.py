@@ -0,0 +1,69 @@
+import pytest
+import threading
+from werkzeug.serving import make_server
+
+from ..util.temptakingWrapper import TemptakingWrapper
+from ..model.updateHandler import UpdateHandler
+from .fakeTemptaking import createFakeTemptaking, TEST_PIN
+from .test_temptakingWrapper import (
+    TEST_URL,
+    TEST_GROUPID,
+    TEST_GROUPNAME,
+    TEST_MEMBER_NOPIN,
+    TEST_MEMBER_PINSET,
+)
+
+
+# Serves the fake website on a random local port for the duration of the tests
+@pytest.fixture(scope="module")
+def fakeBaseUrl():
+    server = make_server("127.0.0.1", 0, createFakeTemptaking(members=500))
+    thread = threading.Thread(target=server.serve_forever, daemon=True)
+    thread.start()
+
+    yield f"http://127.0.0.1:{server.server_port}/group/"
+
+    server.shutdown()
+
+
+@pytest.fixture(autouse=True)
+def useFakeTemptaking(fakeBaseUrl, monkeypatch):
+    monkeypatch.setattr(TemptakingWrapper, "BASE_URL", fakeBaseUrl)
+
+
+class TestFakeTemptaking:
+
+    # Tests loading of the test group
+    def test_load(self):
+        ttWrapper = TemptakingWrapper(TEST_URL)
+        assert ttWrapper.load()
+
+        assert ttWrapper.groupName == TEST_GROUPNAME
+        assert ttWrapper.groupMembers == [TEST_MEMBER_NOPIN, TEST_MEMBER_PINSET]
+
+    # Tests loading of a large group
+    def test_loadRoster(self):
+        ttWrapper = TemptakingWrapper("temptaking.ado.sg/group/loadtest")
+        assert ttWrapper.load()
+        assert len(ttWrapper.groupMembers) == 500
+
+    def test_invalidGroup(self):
+        assert not TemptakingWrapper("temptaking.ado.sg/group/invalid").load()
+
+    # Tests submission responses
+    def test_submit(self):
+        payload = {
+            "groupCode": TEST_GROUPID,
+            "date": "01/01/2021",
+            "meridies": "AM",
+            "memberId": TEST_MEMBER_PINSET["id"],
+            "temperature": 36.0,
+            "pin": TEST_PIN,
+        }
+        assert UpdateHandler.submitter.submit(payload) == "OK"
+
+        payload["pin"] = "9999"
+        assert UpdateHandler.submitter.submit(payload) == "Wrong pin."
+
+        payload["groupCode"] = "invalid"
+        assert UpdateHandler.submitter.submit(payload) == "Invalid code"
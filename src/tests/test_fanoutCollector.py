@@ -0,0 +1,62 @@
+from ..util.fanoutCollector import FanoutCollector
+
+
+class TestFanoutCollector:
+
+    # Tests counts, error histograms and timing summaries
+    def test_summary(self):
+        collector = FanoutCollector(["sendDuration"])
+
+        for i in range(10):
+            collector.add(FanoutCollector.SUCCESS, sendDuration=i / 10)
+        collector.add(FanoutCollector.BLOCKED, (403, "Forbidden"), sendDuration=0.1)
+        collector.add(FanoutCollector.FAILED, (None, "Timed out"), retries=3)
+        collector.add(FanoutCollector.FAILED, (400, "Bad Request"))
+
+        summary = collector.summary()
+
+        assert summary["total"] == 13
+        assert summary["success"] == 10
+        assert summary["blocked"] == 1
+        assert summary["failed"] == 2
+        assert summary["retries"] == 3
+        assert summary["errorCodes"] == {"403": 1, "network": 1, "400": 1}
+        assert summary["timings"]["sendDuration"]["count"] == 11
+
+    # Tests that rare error descriptions are grouped once there are too many
+    def test_maxErrors(self):
+        collector = FanoutCollector()
+
+        for i in range(FanoutCollector.MAX_ERRORS + 5):
+            collector.add(FanoutCollector.FAILED, (400, f"Error {i}"))
+
+        assert len(collector.errors) == FanoutCollector.MAX_ERRORS + 1
+        assert collector.errors["other"] == 5
+
+    # Tests merging the results of part of a run
+    def test_merge(self):
+        collector = FanoutCollector(["sendDuration"])
+        segment = FanoutCollector(["sendDuration"])
+        segment.add(FanoutCollector.SUCCESS, sendDuration=0.5)
+        segment.add(FanoutCollector.FAILED, (500, "Internal Server Error"))
+
+        collector.merge(segment)
+        collector.merge(segment)
+
+        assert len(collector) == 4
+        assert collector.count(FanoutCollector.SUCCESS) == 2
+        assert collector.errorCodes["500"] == 2
+        assert list(collector.timings["sendDuration"]) == [0.5, 0.5]
+
+    # Tests that merging keeps the cap on error descriptions
+    def test_mergeMaxErrors(self):
+        collector = FanoutCollector()
+
+        for i in range(3):
+            segment = FanoutCollector()
+            for j in range(FanoutCollector.MAX_ERRORS):
+                segment.add(FanoutCollector.FAILED, (None, f"Error {i} {j}"))
+            collector.merge(segment)
+
+        assert len(collector.errors) == FanoutCollector.MAX_ERRORS + 1
+        assert collector.errors["other"] == 2 * FanoutCollector.MAX_ERRORS
@@ -0,0 +1,28 @@
+from ..model.groupRoster import GroupRoster
+
+
+def makeMember(memberId: str, name: str, hasPin: bool = True) -> dict:
+    return {"id": memberId, "identifier": name, "hasPin": hasPin}
+
+
+class TestGroupRoster:
+
+    # Tests that members are found by ID
+    def test_member(self):
+        roster = GroupRoster(members=[makeMember("1", "A"), makeMember("2", "B")])
+
+        assert roster.member("2")["identifier"] == "B"
+        assert roster.member("3") is None
+
+    # Tests that renamed members and members that set a PIN are picked up
+    def test_changedSince(self):
+        previous = GroupRoster(
+            members=[makeMember("1", "A"), makeMember("2", "B", False)]
+        )
+        roster = GroupRoster(
+            members=[makeMember("1", "A2"), makeMember("2", "B"), makeMember("3", "C")]
+        )
+
+        assert set(roster.changedSince(previous)) == {"1", "2", "3"}
+        assert roster.changedSince(roster) == {}
+        assert len(roster.changedSince(None)) == 3
@@ -0,0 +1,40 @@
+import gevent
+
+from ..util.keyedLock import KeyedLock
+
+
+class TestKeyedLock:
+
+    # Tests that work on the same key is serialized in arrival order
+    def test_sameKey(self):
+        lock = KeyedLock()
+        order = []
+
+        def work(i):
+            with lock.hold("chat"):
+                order.append(("start", i))
+                gevent.sleep(0.01)
+                order.append(("end", i))
+
+        gevent.joinall([gevent.spawn(work, i) for i in range(3)])
+
+        assert order == [(x, i) for i in range(3) for x in ["start", "end"]]
+        assert len(lock) == 0
+
+    # Tests that work on different keys runs concurrently
+    def test_differentKeys(self):
+        lock = KeyedLock()
+        running = []
+        peak = []
+
+        def work(key):
+            with lock.hold(key):
+                running.append(key)
+                peak.append(len(running))
+                gevent.sleep(0.01)
+                running.remove(key)
+
+        gevent.joinall([gevent.spawn(work, i) for i in range(3)])
+
+        assert max(peak) == 3
+        assert len(lock) == 0
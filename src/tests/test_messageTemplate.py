@@ -0,0 +1,30 @@
+from types import SimpleNamespace
+
+from ..util.messageTemplate import MessageTemplate
+
+
+class TestMessageTemplate:
+
+    # Tests rendering of fields from the recipient
+    def test_render(self):
+        template = MessageTemplate("{memberName}, your group is {groupName}")
+        user = SimpleNamespace(memberName="<TEST>", groupName=None)
+
+        assert not template.isStatic()
+        assert template.render(user) == "&lt;TEST&gt;, your group is "
+
+    # Tests templates without any fields
+    def test_static(self):
+        template = MessageTemplate("<b>Test broadcast</b>")
+
+        assert template.isStatic()
+        assert template.render() == "<b>Test broadcast</b>"
+
+    # Tests that braces other than known fields are sent as they are
+    def test_literalBraces(self):
+        template = MessageTemplate("{pin} {memberName {{x}} {memberName}")
+        user = SimpleNamespace(memberName="TEST")
+
+        assert template.fields == {"memberName"}
+        assert template.render(user) == "{pin} {memberName {{x}} TEST"
+        assert MessageTemplate("{pin} {}").isStatic()
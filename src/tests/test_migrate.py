@@ -0,0 +1,80 @@
+import random
+from datetime import datetime, timedelta
+from google.cloud import ndb, datastore
+
+from ..model.user import User, UserState
+from ..migrate import UserMigration
+from .baseTestClass import BaseTestClass
+
+
+class TestUserMigration:
+
+    # Tests normalisation of statuses and temperatures set by the previous version
+    def test_legacyValues(self):
+        user = User(status="offline,endgame 2", temp="init")
+        changes = UserMigration().migrateUser(user)
+
+        assert user.status == UserState.TEMP_REPORT
+        assert user.temp is None
+        assert changes == ["status", "temp"]
+
+    # Tests that group members are only kept for users still picking their name
+    def test_groupMembers(self):
+        migration = UserMigration()
+
+        user = User(status=UserState.TEMP_DEFAULT, groupMembers="[]")
+        assert migration.migrateUser(user) == ["groupMembers"]
+        assert user.groupMembers is None
+
+        user = User(
+            status=UserState.INIT_GET_NAME,
+            groupMembers="[]",
+            lastActive=datetime.utcnow(),
+        )
+        assert migration.migrateUser(user) == []
+        assert user.groupMembers == "[]"
+
+    # Tests that users that abandoned onboarding are sent back to the start
+    def test_staleOnboarding(self):
+        user = User(
+            status=UserState.INIT_CONFIRM_NAME,
+            groupMembers="[]",
+            lastActive=datetime.utcnow() - timedelta(days=30),
+        )
+        changes = UserMigration().migrateUser(user)
+
+        assert changes == ["stale onboarding"]
+        assert user.status == UserState.INIT_START
+        assert user.groupMembers is None
+
+    # Tests that users without a known last activity are left in onboarding
+    def test_unknownActivity(self):
+        user = User(status=UserState.INIT_CONFIRM_NAME, groupMembers="[]")
+
+        assert UserMigration().migrateUser(user) == []
+        assert user.status == UserState.INIT_CONFIRM_NAME
+
+    # Tests that properties removed from the model are reported as changes
+    def test_staleProperties(self):
+        user = User(status=UserState.TEMP_DEFAULT)
+
+        assert UserMigration().migrateUser(user, ["firstName"]) == ["removed firstName"]
+
+
+class TestUserMigrationStore(BaseTestClass):
+
+    # Tests that a stored property NDB doesn't load is removed from the entity
+    def test_removeStaleProperty(self):
+        client = datastore.Client(
+            project=self.ndbClient.project, namespace=self.ndbClient.namespace
+        )
+        entity = datastore.Entity(client.key("Client", str(random.randint(0, 1e10))))
+        entity.update({"status": UserState.TEMP_DEFAULT, "firstName": "TEST"})
+        client.put(entity)
+
+        key = ndb.Key(User, entity.key.name)
+        count, changes, _ = UserMigration().migratePage([key])
+
+        assert count == 1
+        assert changes["removed firstName"] == 1
+        assert "firstName" not in client.get(entity.key)
@@ -0,0 +1,26 @@
+import gevent
+from time import monotonic
+
+from ..util.rateLimiter import RateLimiter
+
+
+class TestRateLimiter:
+
+    # Tests that a burst is allowed immediately
+    def test_burst(self):
+        limiter = RateLimiter(rate=10, burst=5)
+
+        start = monotonic()
+        for _ in range(5):
+            limiter.acquire()
+
+        assert monotonic() - start < 0.05
+
+    # Tests that calls beyond the burst are spread out at the rate
+    def test_rate(self):
+        limiter = RateLimiter(rate=50, burst=1)
+
+        start = monotonic()
+        gevent.joinall([gevent.spawn(limiter.acquire) for _ in range(11)])
+
+        assert monotonic() - start >= 0.19
@@ -19,3 +19,12 @@ class TestReminder(BaseTestClass):
 
             assert resp.status_code == 200
 
+    # Tests that the timings of the run are recorded
+    def test_reminderRuns(self):
+        url = f"{self.apiUrl}/remind"
+        requests.get(url)
+
+        resp = requests.get(f"{self.apiUrl}/remind/runs", params={"limit": 1})
+
+        assert resp.status_code == 200
+        assert "deliveryLag" in resp.json()[0]
@@ -0,0 +1,48 @@
+import random
+
+from .baseTestClass import BaseTestClass
+
+from ..model.user import User
+from ..model.groupRoster import GroupRoster
+from ..model.rosterHandler import RosterHandler
+
+
+class TestRosterHandler(BaseTestClass):
+
+    # Tests that users are updated from their members, which are matched by ID
+    def test_repairUsers(self):
+        with self.ndbClient.context():
+            groupId = f"TEST_GROUP_{random.randint(0, 1e10)}"
+
+            renamed = self.createUser(
+                {"groupId": groupId, "memberId": "1", "memberName": "A", "pin": "1234"}
+            )
+            pinSet = self.createUser(
+                {"groupId": groupId, "memberId": "2", "memberName": "B", "pin": "False"}
+            )
+            unchanged = self.createUser(
+                {"groupId": groupId, "memberId": "3", "memberName": "C", "pin": "1234"}
+            )
+
+            previous = GroupRoster(
+                members=[
+                    {"id": "1", "identifier": "A", "hasPin": True},
+                    {"id": "2", "identifier": "B", "hasPin": False},
+                    {"id": "3", "identifier": "C", "hasPin": True},
+                ]
+            )
+            roster = GroupRoster(
+                members=[
+                    {"id": "1", "identifier": "A2", "hasPin": True},
+                    {"id": "2", "identifier": "B", "hasPin": True},
+                    {"id": "3", "identifier": "C", "hasPin": True},
+                ]
+            )
+
+            repaired = RosterHandler.repairUsers(groupId, roster.changedSince(previous))
+
+            assert repaired == 2
+            assert renamed.get(use_cache=False).memberName == "A2"
+            assert renamed.get(use_cache=False).pin == "1234"
+            assert pinSet.get(use_cache=False).pin == "True"
+            assert unchanged.get(use_cache=False).memberName == "C"
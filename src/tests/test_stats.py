@@ -0,0 +1,21 @@
+from ..util.stats import percentile, summarise
+
+
+class TestStats:
+
+    # Tests interpolation between values
+    def test_percentile(self):
+        values = [4, 1, 3, 2]
+
+        assert percentile(values, 0) == 1
+        assert percentile(values, 50) == 2.5
+        assert percentile(values, 100) == 4
+        assert percentile([], 50) == 0
+
+    def test_summarise(self):
+        summary = summarise([float(x) for x in range(101)])
+
+        assert summary["count"] == 101
+        assert summary["p50"] == 50
+        assert summary["p99"] == 99
+        assert summary["max"] == 100
@@ -1,3 +1,5 @@
+import requests
+
 from ..util.temptakingWrapper import TemptakingWrapper
 
 TEST_URL = "https://temptaking.ado.sg/group/49c22125544196a0ce745f504bd0608a"
@@ -33,6 +35,14 @@ class TestTemptakingWrapper:
 
         assert not TemptakingWrapper("temptaking.ado.sg/group").isValid()
 
+    # Tests that known groups are looked up on BASE_URL, even for a local stand-in
+    def test_fromGroupId(self, monkeypatch):
+        monkeypatch.setattr(TemptakingWrapper, "BASE_URL", "http://localhost:5001/group/")
+
+        ttWrapper = TemptakingWrapper.fromGroupId("test")
+        assert ttWrapper.isValid()
+        assert ttWrapper.groupUrl == "http://localhost:5001/group/test"
+
     # Tests loading of website
     def test_load(self):
 
@@ -41,3 +51,12 @@ class TestTemptakingWrapper:
 
         assert ttWrapper.groupName == TEST_GROUPNAME
         assert len(ttWrapper.groupMembers) > 0
+
+    # Tests that a page without group data is reported as a failed load
+    def test_loadUnexpectedPage(self, monkeypatch):
+        class Response:
+            content = b"<html><body>Down for maintenance</body></html>"
+
+        monkeypatch.setattr(requests, "get", lambda *args, **kwargs: Response)
+
+        assert not TemptakingWrapper(TEST_URL).load()
@@ -0,0 +1,21 @@
+from ..util.updateDeduplicator import UpdateDeduplicator
+
+
+class TestUpdateDeduplicator:
+
+    # Tests that an update is only reported as new once
+    def test_isDuplicate(self):
+        deduplicator = UpdateDeduplicator()
+
+        assert not deduplicator.isDuplicate(1)
+        assert deduplicator.isDuplicate(1)
+        assert not deduplicator.isDuplicate(None)
+
+    # Tests that a forgotten update is processed again when it is redelivered
+    def test_forget(self):
+        deduplicator = UpdateDeduplicator()
+
+        deduplicator.isDuplicate(1)
+        deduplicator.forget(1)
+
+        assert not deduplicator.isDuplicate(1)
@@ -0,0 +1,68 @@
+import json
+
+from ..util.updateRecorder import UpdateRecorder
+
+
+def createUpdate(text, chatId=42):
+    return {
+        "update_id": 1,
+        "message": {
+            "message_id": 1,
+            "from": {"id": chatId, "first_name": "TEST_USERFIRSTNAME"},
+            "chat": {"id": chatId, "first_name": "TEST_USERFIRSTNAME"},
+            "text": text,
+        },
+    }
+
+
+class TestUpdateRecorder:
+
+    # Tests that personal details are removed but chats can still be told apart
+    def test_anonymise(self):
+        recorder = UpdateRecorder("", "TEST_SALT")
+        update = createUpdate("1234")
+
+        anonymised = recorder.anonymise(update)
+        message = anonymised["message"]
+
+        assert message["chat"]["id"] != 42
+        assert message["chat"]["id"] == message["from"]["id"]
+        assert "first_name" not in message["from"]
+        assert "first_name" not in message["chat"]
+        assert message["text"] == "0000"
+
+        # Original update is unchanged
+        assert update["message"]["chat"]["id"] == 42
+
+    # Tests that free text is masked unless it can't be personal
+    def test_anonymiseText(self):
+        recorder = UpdateRecorder("", "TEST_SALT", keepTexts=["Yes"])
+
+        assert recorder.anonymiseText("Yes") == "Yes"
+        assert recorder.anonymiseText("36.5") == "36.5"
+        assert recorder.anonymiseText("/start now") == "/start"
+        assert recorder.anonymiseText("John Tan") == "xxxxxxxx"
+
+        url = recorder.anonymiseText("https://temptaking.ado.sg/group/abc123")
+        assert url.startswith("https://temptaking.ado.sg/group/")
+        assert "abc123" not in url
+
+    # Tests that recorders without a salt don't map IDs the same way
+    def test_randomSalt(self):
+        update = createUpdate("/start")
+
+        first = UpdateRecorder("").anonymise(update)
+        second = UpdateRecorder("").anonymise(update)
+
+        assert first["message"]["chat"]["id"] != second["message"]["chat"]["id"]
+
+    def test_record(self, tmp_path):
+        path = tmp_path / "updates.jsonl"
+        recorder = UpdateRecorder(str(path))
+
+        recorder.record(createUpdate("36.5"))
+        recorder.record(createUpdate("/start"))
+
+        lines = [json.loads(x) for x in path.read_text().splitlines()]
+        assert [x["update"]["message"]["text"] for x in lines] == ["36.5", "/start"]
+        assert lines[0]["time"] <= lines[1]["time"]
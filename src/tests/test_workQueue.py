@@ -0,0 +1,45 @@
+import gevent
+import pytest
+
+from ..util.workQueue import WorkQueue, QueueFullError
+
+
+class TestWorkQueue:
+
+    # Tests that no more than the concurrency limit run at once
+    def test_concurrency(self):
+        queue = WorkQueue("test_concurrency", 2)
+        peak = []
+
+        def work():
+            with queue.slot():
+                peak.append(queue.running)
+                gevent.sleep(0.01)
+
+        gevent.joinall([gevent.spawn(work) for _ in range(6)])
+
+        assert max(peak) == 2
+        assert queue.gauges()["peak"] == 6
+        assert queue.running == 0 and queue.waiting == 0
+
+    # Tests that work is rejected once the waiting list is full
+    def test_rejected(self):
+        queue = WorkQueue("test_rejected", 1, maxWaiting=1)
+
+        def work():
+            with queue.slot():
+                gevent.sleep(0.05)
+
+        greenlets = [gevent.spawn(work) for _ in range(2)]
+        gevent.sleep(0)
+
+        with pytest.raises(QueueFullError):
+            with queue.slot():
+                pass
+
+        gevent.joinall(greenlets)
+        assert queue.rejected == 1
+
+        # Slots are free again once the work is done
+        with queue.slot():
+            assert queue.running == 1
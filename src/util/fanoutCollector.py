@@ -0,0 +1,99 @@
+#
+#   Collects the results of messages sent in a fan-out (reminders and broadcasts)
+#   Results are kept in compact arrays instead of a tuple per message, and failures
+#   are counted by error instead of being logged one by one
+#
+
+from time import time
+from array import array
+from collections import Counter
+
+from .stats import percentile, summarise
+
+
+class FanoutCollector:
+
+    # Status of each message
+    SUCCESS = 0
+    FAILED = 1
+    BLOCKED = -1
+
+    # Number of distinct error descriptions kept, the rest are counted as "other"
+    MAX_ERRORS = 20
+
+    # timings are the names of the timings recorded for each message
+    def __init__(self, timings: list = ()):
+        self.start = time()
+
+        self.statuses = array("b")
+        self.retries = 0
+        self.timings = {name: array("d") for name in timings}
+
+        # Error code -> count, and Telegram error description -> count
+        self.errorCodes = Counter()
+        self.errors = Counter()
+
+    # error is the (error code, description) of a failed message
+    # The error code is None if the request didn't reach Telegram, and the description
+    # should then be the exception's class name so that it can be counted
+    # Timings are only recorded for the names given, and can be left out
+    def add(self, status: int, error: tuple = None, retries: int = 0, **timings):
+
+        self.statuses.append(status)
+        self.retries += retries
+
+        if error is not None:
+            code, description = error
+            # JSON object keys have to be strings
+            self.errorCodes[str(code or "network")] += 1
+            self.addErrorCounts(self.errors, {description: 1})
+
+        for name, value in timings.items():
+            self.timings[name].append(value)
+
+    # Adds the results of another collector, e.g. one covering part of the run
+    def merge(self, other: "FanoutCollector"):
+        self.statuses.extend(other.statuses)
+        self.retries += other.retries
+        self.errorCodes.update(other.errorCodes)
+        self.addErrorCounts(self.errors, other.errors)
+
+        for name, values in other.timings.items():
+            self.timings.setdefault(name, array("d")).extend(values)
+
+    # Adds counts of error descriptions, keeping at most MAX_ERRORS descriptions
+    @classmethod
+    def addErrorCounts(cls, errors: Counter, counts: dict):
+        for description, count in counts.items():
+            if description in errors or len(errors) < cls.MAX_ERRORS:
+                errors[description] += count
+            else:
+                errors["other"] += count
+
+    def __len__(self):
+        return len(self.statuses)
+
+    def count(self, status: int) -> int:
+        return self.statuses.count(status)
+
+    def elapsedTime(self) -> float:
+        return time() - self.start
+
+    def percentile(self, name: str, q: float) -> float:
+        return percentile(self.timings[name], q)
+
+    def summary(self) -> dict:
+        elapsedTime = self.elapsedTime()
+
+        return {
+            "total": len(self),
+            "success": self.count(self.SUCCESS),
+            "failed": self.count(self.FAILED),
+            "blocked": self.count(self.BLOCKED),
+            "retries": self.retries,
+            "elapsedTime": elapsedTime,
+            "rate": len(self) / elapsedTime if elapsedTime > 0 else 0,
+            "errorCodes": dict(self.errorCodes),
+            "errors": dict(self.errors.most_common()),
+            "timings": {name: summarise(x) for name, x in self.timings.items()},
+        }
@@ -0,0 +1,33 @@
+#
+#   Per-key locks for serializing work on the same entity across greenlets
+#
+
+from contextlib import contextmanager
+from gevent.lock import Semaphore
+
+
+class KeyedLock:
+    def __init__(self):
+        # Key -> [lock, number of greenlets holding or waiting for the lock]
+        self._locks = {}
+
+    # Greenlets holding different keys never block each other
+    # Waiting greenlets acquire the lock in the order they arrived
+    @contextmanager
+    def hold(self, key):
+
+        entry = self._locks.setdefault(key, [Semaphore(), 0])
+        entry[1] += 1
+
+        try:
+            with entry[0]:
+                yield
+        finally:
+            entry[1] -= 1
+
+            # Drop locks that nobody is waiting on so the dict stays small
+            if entry[1] == 0:
+                del self._locks[key]
+
+    def __len__(self):
+        return len(self._locks)
@@ -0,0 +1,37 @@
+#
+#   Broadcast text that is personalised with fields of each recipient's User entity
+#   e.g. "{memberName}, your group {groupName} ..."
+#   Only the known fields are substituted, so any other braces are sent as they are
+#
+
+import re
+import html
+
+
+class MessageTemplate:
+
+    # User properties that can be used in a template
+    FIELDS = ["memberName", "groupName", "groupId"]
+    FIELD_PATTERN = re.compile(r"\{(" + "|".join(FIELDS) + r")\}")
+
+    def __init__(self, text: str):
+        self.text = text
+
+        # The template is split once into literal text and field names, alternately
+        self._parts = self.FIELD_PATTERN.split(text)
+        self.fields = set(self._parts[1::2])
+
+    # Static templates don't need the recipients' User entities
+    def isStatic(self) -> bool:
+        return len(self.fields) == 0
+
+    def render(self, user=None) -> str:
+        if self.isStatic():
+            return self.text
+
+        text = list(self._parts)
+        for i in range(1, len(text), 2):
+            # Messages are sent as HTML
+            text[i] = html.escape(getattr(user, text[i]) or "")
+
+        return "".join(text)
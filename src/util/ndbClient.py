@@ -0,0 +1,64 @@
+#
+#   Shared Cloud NDB client for the whole application
+#
+
+import os
+from functools import wraps
+from google.cloud import ndb
+
+from .workQueue import WorkQueue
+
+_client = None
+
+# Limits concurrent Datastore calls made while handling updates
+datastoreQueue = WorkQueue(
+    "datastore", int(os.environ.get("DATASTORE_CONCURRENCY", 50))
+)
+
+
+# The client is created lazily so that gRPC channels are opened in the worker
+# that uses them and not in the gunicorn master before forking
+def getNdbClient() -> ndb.Client:
+    global _client
+
+    if _client is None:
+        _client = ndb.Client()
+
+    return _client
+
+
+# Contexts left by greenlets that have finished, to be reused by later greenlets
+_idleContexts = []
+
+
+# NDB contexts are stored per greenlet when gevent is patched in, so greenlets
+# spawned in a fan-out can't see the context of the request that spawned them.
+# The request's context can't be passed to them either, as a context's event loop
+# and batches aren't safe to use from concurrently running greenlets. Instead, each
+# greenlet takes a context no other greenlet is using, and returns it when it is done
+# so that a fan-out only creates as many contexts as it runs greenlets at a time
+def withContext(fn):
+    @wraps(fn)
+    def wrapper(*args, **kwargs):
+
+        # Already running inside a context (e.g. called from the parent greenlet)
+        if ndb.get_context(False) is not None:
+            return fn(*args, **kwargs)
+
+        if _idleContexts:
+            context = _idleContexts.pop()
+            with context.use():
+                result = fn(*args, **kwargs)
+                # Finish any calls left pending, as leaving client.context() would
+                context.eventloop.run()
+        else:
+            with getNdbClient().context() as context:
+                result = fn(*args, **kwargs)
+
+        # Contexts of greenlets that raised are dropped in case they were left broken
+        context.cache.clear()
+        _idleContexts.append(context)
+
+        return result
+
+    return wrapper
@@ -2,14 +2,15 @@
 #   WSGI middleware for exposing the Cloud NDB context to all requests
 #
 
-from google.cloud import ndb
+from .ndbClient import getNdbClient
 
 
 class NdbMiddleware:
     def __init__(self, app):
         self.app = app
-        self.context = ndb.Client().context()
 
+    # Each request gets its own context since contexts can't be shared between
+    # concurrently running greenlets, but all of them use the same client
     def __call__(self, env, start_response):
-        with self.context:
+        with getNdbClient().context():
             return self.app(env, start_response)
@@ -0,0 +1,39 @@
+#
+#   Streams query results page by page with cursors so that large result sets
+#   never have to be held in memory at once
+#
+
+from google.cloud import ndb
+
+from .ndbClient import getNdbClient
+
+
+def _fetchPages(query: ndb.Query, pageSize: int, startCursor: ndb.Cursor, options):
+    cursor, more = startCursor, True
+
+    while more:
+        results, cursor, more = query.fetch_page(
+            pageSize, start_cursor=cursor, **options
+        )
+        yield results, cursor, more
+
+
+# Yields (results, cursor after the page, whether there are more pages)
+# Pages are only fetched as the iterator is consumed
+def iterPages(
+    query: ndb.Query, pageSize: int, startCursor: ndb.Cursor = None, **options
+):
+
+    # Iterators passed to imap_unordered are consumed in a separate greenlet that
+    # doesn't have the caller's context
+    if ndb.get_context(False) is None:
+        with getNdbClient().context():
+            yield from _fetchPages(query, pageSize, startCursor, options)
+    else:
+        yield from _fetchPages(query, pageSize, startCursor, options)
+
+
+# Yields the results of all pages one at a time
+def iterResults(query: ndb.Query, pageSize: int, **options):
+    for results, _, _ in iterPages(query, pageSize, **options):
+        yield from results
@@ -0,0 +1,88 @@
+#
+#   Opt-in statistical profiler for individual requests
+#   Profiles are returned as collapsed stacks that can be turned into flamegraphs
+#   e.g. with flamegraph.pl or speedscope
+#
+
+import signal
+import logging
+from collections import Counter
+from functools import wraps
+from flask import request, Response
+from gevent.lock import Semaphore
+
+logger = logging.getLogger(__name__)
+
+
+class SamplingProfiler:
+
+    # Seconds of CPU time between samples
+    INTERVAL = 0.002
+
+    def __init__(self, interval: float = INTERVAL):
+        self.interval = interval
+        self.samples = Counter()
+
+    def _sample(self, signum, frame):
+        stack = []
+        while frame is not None:
+            code = frame.f_code
+            stack.append(f"{code.co_name} ({code.co_filename}:{frame.f_lineno})")
+            frame = frame.f_back
+
+        self.samples[";".join(reversed(stack))] += 1
+
+    # Samples are taken from whatever is running when the timer fires, so concurrent
+    # greenlets (e.g. other requests) may show up in the profile
+    # Signals can only be handled in the main thread, which is where gevent runs
+    def __enter__(self):
+        self._previous = signal.signal(signal.SIGPROF, self._sample)
+        signal.setitimer(signal.ITIMER_PROF, self.interval, self.interval)
+        return self
+
+    def __exit__(self, *args):
+        signal.setitimer(signal.ITIMER_PROF, 0, 0)
+        signal.signal(signal.SIGPROF, self._previous)
+
+    # One line per unique stack followed by the number of samples
+    def collapsed(self) -> str:
+        return "\n".join(f"{stack} {count}" for stack, count in self.samples.items())
+
+
+# Only one request can be profiled at a time since there is a single timer
+_profiling = Semaphore()
+
+
+# Decorator for routes that profiles the request when it carries the admin token in
+# the X-Profile-Token header or the ?profile= query parameter
+# The response of a profiled request is replaced by the collapsed stacks
+def profiled(adminToken: str):
+    def decorator(fn):
+
+        # Profiling is disabled without an admin token
+        if not adminToken:
+            return fn
+
+        @wraps(fn)
+        def wrapper(*args, **kwargs):
+
+            token = request.headers.get("X-Profile-Token") or request.args.get(
+                "profile"
+            )
+            if token != adminToken or not _profiling.acquire(blocking=False):
+                return fn(*args, **kwargs)
+
+            try:
+                with SamplingProfiler() as profiler:
+                    fn(*args, **kwargs)
+            finally:
+                _profiling.release()
+
+            logger.info(
+                f"Profiled {request.path} with {sum(profiler.samples.values())} samples"
+            )
+            return Response(profiler.collapsed(), mimetype="text/plain")
+
+        return wrapper
+
+    return decorator
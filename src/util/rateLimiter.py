@@ -0,0 +1,34 @@
+#
+#   Token bucket rate limiter for greenlets
+#
+
+import gevent
+from time import monotonic
+from gevent.lock import Semaphore
+
+
+class RateLimiter:
+
+    # Allows rate calls per second on average and bursts of up to burst calls
+    def __init__(self, rate: float, burst: int = 1):
+        self.rate = rate
+        self.burst = burst
+        self.tokens = burst
+        self.updated = monotonic()
+        # Waiters are served one at a time in the order they arrive
+        self.lock = Semaphore()
+
+    def _refill(self):
+        now = monotonic()
+        self.tokens = min(self.burst, self.tokens + (now - self.updated) * self.rate)
+        self.updated = now
+
+    # Blocks the calling greenlet until a call is allowed
+    def acquire(self):
+        with self.lock:
+            self._refill()
+            if self.tokens < 1:
+                gevent.sleep((1 - self.tokens) / self.rate)
+                self._refill()
+
+            self.tokens -= 1
@@ -0,0 +1,32 @@
+#
+#   Summary statistics for timings collected during fan-outs
+#
+
+from typing import List
+
+
+# Returns the q-th percentile (0-100) of the values using linear interpolation
+def percentile(values: List[float], q: float) -> float:
+
+    if not values:
+        return 0
+
+    values = sorted(values)
+    pos = (len(values) - 1) * q / 100
+    lo = int(pos)
+    hi = min(lo + 1, len(values) - 1)
+
+    return values[lo] + (values[hi] - values[lo]) * (pos - lo)
+
+
+# Percentile summary used for reporting latencies
+def summarise(values: List[float]) -> dict:
+    values = sorted(values)
+
+    return {
+        "count": len(values),
+        "p50": round(percentile(values, 50), 4),
+        "p90": round(percentile(values, 90), 4),
+        "p99": round(percentile(values, 99), 4),
+        "max": round(values[-1], 4) if values else 0,
+    }
@@ -1,20 +1,45 @@
+import os
 import json
 import requests
+from requests.adapters import HTTPAdapter
+
+from .workQueue import WorkQueue
 
 
 class TelegramApiWrapper:
+
+    # Maximum number of connections kept open to Telegram (matches fan-out concurrency)
+    POOL_SIZE = 100
+    # Seconds a request can take before it is abandoned and its connection freed
+    REQUEST_TIMEOUT = 10
+
+    # Can be pointed at a local stand-in of the Bot API (see tests/fakeTelegram.py)
+    API_URL = os.environ.get("TELEGRAM_API_URL", "https://api.telegram.org")
+
+    # Requests beyond the connection pool wait for a connection to be freed
+    requestQueue = WorkQueue(
+        "telegram", int(os.environ.get("TELEGRAM_CONCURRENCY", POOL_SIZE))
+    )
+
     def __init__(self, token):
         self.token = token
 
+        # Connections are reused across requests instead of a new TLS handshake each time
+        self.session = requests.Session()
+        adapter = HTTPAdapter(pool_connections=1, pool_maxsize=self.POOL_SIZE)
+        self.session.mount("https://", adapter)
+        self.session.mount("http://", adapter)
+
     # Sends a POST request with a JSON payload to the specified URL
     # Returns the JSON response
-    def _postJson(self, json, url):
-        r = requests.post(url, json=json)
-        return r.json()
+    def _postJson(self, json, url, timeout=REQUEST_TIMEOUT):
+        with self.requestQueue.slot():
+            r = self.session.post(url, json=json, timeout=timeout)
+            return r.json()
 
     # Returns the endpoint URL corresponding to the method
     def _makeApiUrl(self, method) -> str:
-        return "https://api.telegram.org/bot{}/{}".format(self.token, method)
+        return "{}/bot{}/{}".format(self.API_URL, self.token, method)
 
     # Sends a message represented in JSON
     def sendMessage(self, json):
@@ -23,8 +48,27 @@ class TelegramApiWrapper:
     def getMe(self):
         return self._postJson({}, self._makeApiUrl("getMe"))
 
-    def setWebhook(self, webhookUrl):
-        return self._postJson({"url": webhookUrl}, self._makeApiUrl("setWebhook"))
+    # allowedUpdates limits the update types Telegram will send to the webhook
+    def setWebhook(self, webhookUrl, allowedUpdates: list = None):
+        payload = {"url": webhookUrl}
+        if allowedUpdates is not None:
+            payload["allowed_updates"] = allowedUpdates
+
+        return self._postJson(payload, self._makeApiUrl("setWebhook"))
 
     def clearWebhook(self):
         return self.setWebhook("")
+
+    # Long polls for updates, blocking for up to timeout seconds if there are none
+    # Updates before offset are acknowledged and will not be returned again
+    def getUpdates(self, offset=None, limit=100, timeout=30, allowedUpdates=None):
+        payload = {"limit": limit, "timeout": timeout}
+        if offset is not None:
+            payload["offset"] = offset
+        if allowedUpdates is not None:
+            payload["allowed_updates"] = allowedUpdates
+
+        # Allow for the server holding the request open for the whole poll
+        return self._postJson(
+            payload, self._makeApiUrl("getUpdates"), timeout=timeout + 10
+        )
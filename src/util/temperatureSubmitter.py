@@ -0,0 +1,46 @@
+#
+#   Submits temperatures to temptaking.ado.sg over a pooled session, sharing the cap
+#   on concurrent requests to the website with TemptakingWrapper
+#   The website only accepts one temperature per request, so submissions are sent as
+#   soon as they arrive
+#
+
+import logging
+import requests
+from requests.adapters import HTTPAdapter
+
+from .temptakingWrapper import TemptakingWrapper
+
+logger = logging.getLogger(__name__)
+
+
+class TemperatureSubmitter:
+
+    TIMEOUT = 15
+
+    def __init__(self):
+
+        # Connections are kept alive and shared by all submissions
+        self._session = requests.Session()
+        adapter = HTTPAdapter(
+            pool_connections=1,
+            pool_maxsize=TemptakingWrapper.requestQueue.concurrency,
+        )
+        self._session.mount("https://", adapter)
+        self._session.mount("http://", adapter)
+
+    # Submits a temperature and blocks until the website responds
+    # Returns the response text from the website, or "error" if the request failed
+    def submit(self, payload: dict) -> str:
+
+        url = TemptakingWrapper.BASE_URL + "MemberSubmitTemperature"
+
+        with TemptakingWrapper.requestQueue.slot():
+            try:
+                resp = self._session.post(url, data=payload, timeout=self.TIMEOUT)
+                logger.debug("Temperature submission returned: {}".format(resp.text))
+                return resp.text
+
+            except Exception as e:
+                logger.error(e)
+                return "error"
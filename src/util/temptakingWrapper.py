@@ -1,28 +1,53 @@
+import os
 import re
 import json
 import requests
 import logging
 
+from .workQueue import WorkQueue
+
 logger = logging.getLogger(__name__)
 
 
 class TemptakingWrapper:
 
-    URL_PATTERN = r"temptaking\.ado\.sg/group/.*"
-    BASE_URL = "https://temptaking.ado.sg/group/"
+    URL_PATTERN = r"temptaking\.ado\.sg/group/(.*)"
+    # Can be pointed at a local stand-in of the website (see tests/fakeTemptaking.py)
+    BASE_URL = os.environ.get(
+        "TEMPTAKING_BASE_URL", "https://temptaking.ado.sg/group/"
+    )
+
+    # Seconds to connect and to wait for the page, so a hung website frees its slot
+    TIMEOUT = (5, 15)
+
+    # Shared by all requests to the website, including submissions
+    requestQueue = WorkQueue(
+        "temptaking", int(os.environ.get("TEMPTAKING_CONCURRENCY", 10))
+    )
 
-    def __init__(self, groupUrl: str):
+    # Groups that are already known are given by ID instead of a URL, so that they
+    # are found on BASE_URL even if it is a stand-in that doesn't match URL_PATTERN
+    def __init__(self, groupUrl: str = None, groupId: str = None):
         self._isValid = False
 
+        if groupId is not None:
+            self.groupUrl = self.BASE_URL + groupId
+            self._isValid = True
+            return
+
         # Check if URL matches the temptaking website URL
         matches = re.findall(self.URL_PATTERN, groupUrl)
         if len(matches) > 0:
-            self.groupUrl = f"https://{matches[0]}"
+            self.groupUrl = self.BASE_URL + matches[0]
             self._isValid = True
 
         else:
             logger.info(f"Received invalid URL: {groupUrl}")
 
+    @classmethod
+    def fromGroupId(cls, groupId: str) -> "TemptakingWrapper":
+        return cls(groupId=groupId)
+
     def isValid(self):
         return self._isValid
 
@@ -32,7 +57,8 @@ class TemptakingWrapper:
             return False
 
         try:
-            resp = requests.get(self.groupUrl)
+            with self.requestQueue.slot():
+                resp = requests.get(self.groupUrl, timeout=self.TIMEOUT)
             html = resp.content.decode("utf-8")
         except:
             logger.warning(
@@ -46,14 +72,18 @@ class TemptakingWrapper:
             return False
 
         # We don't have an actual endpoint so just scrape data from their script tag
-        start = html.find("loadContents") + 14
-        end = html.rfind("}") + 1
-        groupData = json.loads(html[start:end])
-
+        start = html.find("loadContents")
+        end = html.rfind("}")
         if start == -1 or end == -1:
             logger.warning(f"Failed to scrape group data from {self.groupUrl}")
             return False
 
+        try:
+            groupData = json.loads(html[start + 14 : end + 1])
+        except ValueError:
+            logger.warning(f"Failed to parse group data from {self.groupUrl}")
+            return False
+
         self.groupName: str = groupData["groupName"]
         self.groupId: str = groupData["groupCode"]
         self.groupMembers = groupData["members"]
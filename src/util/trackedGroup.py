@@ -0,0 +1,41 @@
+#
+#   gevent Group that can be drained on worker shutdown
+#
+
+import logging
+from weakref import WeakSet
+from gevent.pool import Group
+from gevent.timeout import Timeout
+
+logger = logging.getLogger(__name__)
+
+
+class TrackedGroup(Group):
+
+    # Groups that may still have running greenlets
+    _active = WeakSet()
+
+    def __init__(self, *args, **kwargs):
+        super().__init__(*args, **kwargs)
+        TrackedGroup._active.add(self)
+
+    # Waits for all in-flight fan-out greenlets to finish
+    # Returns False if the timeout expired before everything was drained
+    @classmethod
+    def drainAll(cls, timeout: float = None) -> bool:
+
+        groups = [x for x in cls._active if len(x) > 0]
+        if not groups:
+            return True
+
+        logger.info(f"Draining {sum(len(x) for x in groups)} greenlets")
+
+        try:
+            with Timeout(timeout):
+                for group in groups:
+                    group.join()
+        except Timeout:
+            logger.warning("Timed out while draining greenlets")
+            return False
+
+        return True
@@ -0,0 +1,84 @@
+#
+#   Tracks recently seen update IDs so that updates redelivered by Telegram
+#   are only processed once
+#
+
+import logging
+from time import time
+from collections import OrderedDict
+
+logger = logging.getLogger(__name__)
+
+
+class UpdateDeduplicator:
+
+    # Telegram gives up redelivering an update well within this window
+    TTL = 600
+    MAX_SIZE = 10000
+
+    def __init__(self, redisUrl: str = None, ttl: int = TTL, maxSize: int = MAX_SIZE):
+        self.ttl = ttl
+        self.maxSize = maxSize
+
+        # Update ID -> expiry time, oldest first
+        self._seen = OrderedDict()
+
+        # Redis is optional and only needed to deduplicate across instances
+        self._redis = None
+        if redisUrl:
+            import redis
+
+            self._redis = redis.Redis.from_url(redisUrl, socket_timeout=0.5)
+
+    # Removes expired entries and enforces the size bound
+    def _evict(self, now: float):
+        while self._seen:
+            updateId, expiry = next(iter(self._seen.items()))
+            if expiry > now and len(self._seen) <= self.maxSize:
+                break
+
+            self._seen.popitem(last=False)
+
+    # Returns True if the update has already been seen, otherwise marks it as seen
+    def isDuplicate(self, updateId) -> bool:
+
+        # Spoofed or malformed updates can't be deduplicated
+        if updateId is None:
+            return False
+
+        now = time()
+        self._evict(now)
+
+        if updateId in self._seen:
+            return True
+
+        self._seen[updateId] = now + self.ttl
+
+        if self._redis is not None:
+            try:
+                # Only succeeds for the first instance to see this update
+                isNew = self._redis.set(
+                    f"thermobot:update:{updateId}", 1, nx=True, ex=self.ttl
+                )
+                return not isNew
+
+            except Exception as e:
+                # Fall back to the in-memory cache
+                logger.warning(f"Failed to check update against Redis: {e}")
+
+        return False
+
+    # Unmarks an update that failed to be processed so that its redelivery isn't
+    # treated as a duplicate
+    def forget(self, updateId):
+
+        if updateId is None:
+            return
+
+        self._seen.pop(updateId, None)
+
+        if self._redis is not None:
+            try:
+                self._redis.delete(f"thermobot:update:{updateId}")
+            except Exception as e:
+                logger.warning(f"Failed to remove update from Redis: {e}")
@@ -0,0 +1,96 @@
+#
+#   Records incoming updates to a JSONL file so that production traffic can be
+#   replayed locally (see replay.py)
+#
+
+import re
+import json
+import hashlib
+import logging
+import secrets
+from time import time
+
+logger = logging.getLogger(__name__)
+
+# PINs are replaced with the PIN accepted by the temptaking stand-in
+PIN_PATTERN = re.compile(r"^\s*\d{4}\s*$")
+REPLACEMENT_PIN = "0000"
+
+# Text that is kept as it was sent, besides the keyboard replies given to the recorder
+COMMAND_PATTERN = re.compile(r"^/\w+")
+TEMP_PATTERN = re.compile(r"^\s*\d{2}(\.\d)?\s*$")
+# Group codes are pseudonymised like IDs
+GROUP_URL_PATTERN = re.compile(r"temptaking\.ado\.sg/group/(\w+)")
+
+# Personal fields that are dropped from users and chats
+PERSONAL_FIELDS = ["first_name", "last_name", "username", "title"]
+
+
+class UpdateRecorder:
+
+    # keepTexts are texts that can't be personal, e.g. the bot's keyboard replies
+    # Without a salt, IDs are only stable for the lifetime of the recorder
+    def __init__(self, path: str, salt: str = None, keepTexts=()):
+        self.path = path
+        self.salt = salt or secrets.token_hex(16)
+        self.keepTexts = set(keepTexts)
+
+    # Maps an ID to a stable pseudonymous ID so that updates from the same chat
+    # can still be grouped together
+    def _anonymiseId(self, value) -> int:
+        digest = hashlib.sha256(f"{self.salt}{value}".encode()).digest()
+        return int.from_bytes(digest[:6], "big")
+
+    # Free text may contain names, group codes and PINs, so only its length is kept
+    def anonymiseText(self, text: str) -> str:
+        if text in self.keepTexts or TEMP_PATTERN.match(text):
+            return text
+
+        if PIN_PATTERN.match(text):
+            return REPLACEMENT_PIN
+
+        command = COMMAND_PATTERN.match(text)
+        if command:
+            return command.group(0)
+
+        group = GROUP_URL_PATTERN.search(text)
+        if group:
+            return f"https://temptaking.ado.sg/group/{self._anonymiseId(group[1])}"
+
+        return "x" * len(text)
+
+    def anonymise(self, body: dict) -> dict:
+        body = json.loads(json.dumps(body))
+
+        for updateType in ["message", "edited_message"]:
+            message = body.get(updateType)
+            if not isinstance(message, dict):
+                continue
+
+            for field in ["from", "chat"]:
+                if isinstance(message.get(field), dict):
+                    obj = message[field]
+                    if "id" in obj:
+                        obj["id"] = self._anonymiseId(obj["id"])
+                    for personal in PERSONAL_FIELDS:
+                        obj.pop(personal, None)
+
+            text = message.get("text")
+            if isinstance(text, str):
+                message["text"] = self.anonymiseText(text)
+
+            # Replies and forwards may contain messages from other users
+            for field in ["reply_to_message", "forward_from", "forward_from_chat"]:
+                message.pop(field, None)
+
+        return body
+
+    # Appends the update with the time it was received
+    def record(self, body: dict):
+        try:
+            line = json.dumps({"time": time(), "update": self.anonymise(body)})
+            with open(self.path, "a", encoding="utf-8") as ff:
+                ff.write(line + "\n")
+
+        except Exception as e:
+            logger.warning(f"Failed to record update: {e}")
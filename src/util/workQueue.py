@@ -0,0 +1,74 @@
+#
+#   Bounds the number of greenlets working on something at once
+#   Greenlets over the limit wait for a slot, and once enough are waiting new work
+#   is rejected instead of piling up
+#
+
+from contextlib import contextmanager
+from gevent.lock import BoundedSemaphore
+
+
+class QueueFullError(Exception):
+    pass
+
+
+class WorkQueue:
+
+    # Name -> queue, for reporting
+    _queues = {}
+
+    # maxWaiting is the number of greenlets that can wait for a slot, or None for
+    # no limit
+    def __init__(self, name: str, concurrency: int, maxWaiting: int = None):
+        self.name = name
+        self.concurrency = concurrency
+        self.maxWaiting = maxWaiting
+
+        self._slots = BoundedSemaphore(concurrency)
+        self.running = 0
+        self.waiting = 0
+        self.peak = 0
+        self.rejected = 0
+
+        WorkQueue._queues[name] = self
+
+    # Blocks until a slot is free
+    # Raises QueueFullError straight away if too many greenlets are waiting
+    @contextmanager
+    def slot(self):
+
+        if (
+            self.maxWaiting is not None
+            and self._slots.locked()
+            and self.waiting >= self.maxWaiting
+        ):
+            self.rejected += 1
+            raise QueueFullError(self.name)
+
+        self.waiting += 1
+        self.peak = max(self.peak, self.running + self.waiting)
+        try:
+            self._slots.acquire()
+        finally:
+            self.waiting -= 1
+
+        self.running += 1
+        try:
+            yield
+        finally:
+            self.running -= 1
+            self._slots.release()
+
+    def gauges(self) -> dict:
+        return {
+            "concurrency": self.concurrency,
+            "maxWaiting": self.maxWaiting,
+            "running": self.running,
+            "waiting": self.waiting,
+            "peak": self.peak,
+            "rejected": self.rejected,
+        }
+
+    @classmethod
+    def allGauges(cls) -> dict:
+        return {name: queue.gauges() for name, queue in cls._queues.items()}
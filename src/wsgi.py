@@ -6,12 +6,14 @@ from gevent.pywsgi import WSGIServer
 from werkzeug.serving import run_with_reloader
 
 from .app import create_app
+from .model.replyOutbox import ReplyOutbox
 
 
 @run_with_reloader
 def runServer():
 
     server = WSGIServer(("127.0.0.1", 5000), create_app())
+    ReplyOutbox.startAll()
     server.serve_forever()
 
 
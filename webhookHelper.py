@@ -12,6 +12,9 @@ import sys
 import threading
 from pprint import pprint as pp
 
+# Only updates that the bot can respond to are delivered to the webhook
+ALLOWED_UPDATES = ["message", "edited_message"]
+
 # Returns the endpoint URL for a Telegram Bot API method
 def getUrl(token, method):
     return "https://api.telegram.org/bot{}/{}".format(token, method)
@@ -53,7 +56,10 @@ def setWebhook(token, baseUrl):
     # Endpoint for the bot
     url = "{}/{}/webhook".format(baseUrl, token)
 
-    r = requests.post(getUrl(token, "setWebhook"), data={"url": url})
+    r = requests.post(
+        getUrl(token, "setWebhook"),
+        json={"url": url, "allowed_updates": ALLOWED_UPDATES},
+    )
     res = r.json()
 
     if res["ok"]: